@@ -1,17 +1,34 @@
 import json
-from collections.abc import Sequence, Mapping
+import queue
+import re
+import sys
+import time
+from collections import deque
+from collections.abc import Sequence, Mapping, Callable, Iterable, Iterator
+from copy import deepcopy
 from dataclasses import dataclass
 from functools import partial
+from itertools import islice
 from pprint import pprint
 import screept
+import screept_compiler
+import screept_optimizer
 from typing import Optional
 
+# Compiled closures by default; point these at screept.evaluate_expression / screept.run_statement
+# to run the game on the reference tree-walker.
+evaluate_expression = screept_compiler.evaluate_expression
+run_statement = screept_compiler.run_statement
+
+# calls the screept of one action may make before it fails with OutOfFuel, see screept_compiler.limited
+ACTION_FUEL = 100_000
+
 
 def parse_value(d) -> screept.Value:
     match d:
 
         case {"type": "number", "value": x}:
-            return screept.ValueNumber(x)
+            return screept.number(x)
         case {"type": "text", "value": x}:
             return screept.ValueString(x)
         case {"type": "func", "value": x}:
@@ -93,10 +110,70 @@ def process_procedure(v):
     return name, parse_statement(value)
 
 
+class DialogStack(Sequence[str]):
+    """Dialogs the player went through, the current one first. Pushing and popping the current dialog is O(1)
+    however deep the history. With `max_depth` the oldest entries are dropped past it. With `max_cycle`, a push
+    that makes the last k <= max_cycle dialogs repeat the k before them drops the repeat, so walking back and forth
+    between dialogs doesn't grow the stack; going back then skips the repeats."""
+    __slots__ = ('_items', 'max_cycle')
+
+    def __init__(self, items: Iterable[str] = (), max_depth: Optional[int] = None, max_cycle: int = 0):
+        # the current dialog is on the left, the oldest entries go first when maxlen is reached
+        self._items: deque[str] = deque(islice(items, max_depth), max_depth)
+        self.max_cycle = max_cycle
+
+    @property
+    def max_depth(self) -> Optional[int]:
+        return self._items.maxlen
+
+    def push(self, dialog_id: str) -> None:
+        items = self._items
+        items.appendleft(dialog_id)
+        # the stack had no repeats before, so only one ending in the new dialog can be there now
+        head = items[0]
+        for k in range(1, min(self.max_cycle, len(items) // 2) + 1):
+            if items[k] == head and all(items[i] == items[i + k] for i in range(1, k)):
+                for _ in range(k):
+                    items.popleft()
+                break
+
+    def pop(self) -> str:
+        return self._items.popleft()
+
+    def compact(self) -> None:
+        """Drops the repeats of a stack loaded without max_cycle, e.g. before saving it"""
+        items = list(self._items)
+        self._items.clear()
+        for dialog_id in reversed(items):
+            self.push(dialog_id)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self._items)[index]
+        return self._items[index]
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._items)
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, DialogStack):
+            return self._items == other._items
+        return isinstance(other, list) and list(self._items) == other
+
+    def __reduce__(self):
+        return DialogStack, (list(self._items), self.max_depth, self.max_cycle)
+
+    def __repr__(self) -> str:
+        return f"DialogStack({list(self._items)!r})"
+
+
 @dataclass
 class GameState:
     environment: screept.Environment
-    dialog_stack: list[str]
+    dialog_stack: DialogStack
 
 
 class DialogAction:
@@ -154,6 +231,7 @@ class Dialog:
 class GameDefinition:
     game_state: GameState
     dialogs: Mapping[str, Dialog]
+    removed_nodes: int = 0
 
 
 def parse_action(x) -> DialogAction:
@@ -190,33 +268,226 @@ def parse_dialog(x) -> Dialog:
     return Dialog(x['id'], parse_expression(x['text']), list(map(parse_option, x['options'])))
 
 
-def load_game(title: str) -> GameDefinition:
-    with open("data/" + title + ".json", "r") as f:
-        data = json.load(f)
-        game_state = data['gameState']
-        # print(data.keys())
-        env = game_state['screeptEnv']
-        dialog_stack: list[str] = game_state['dialogStack']
-        # print(data['dialogs'])
-        dialogs = [(x[0], parse_dialog(x[1])) for x in data['dialogs'].items()]
+def optimize_action(optimizer: screept_optimizer.Optimizer, action: DialogAction) -> DialogAction:
+    match action:
+        case DAScreept(value):
+            return DAScreept(optimizer.statement(value))
+        case DAConditional(condition, then_actions, else_actions):
+            return DAConditional(optimizer.expression(condition),
+                                 [optimize_action(optimizer, a) for a in then_actions],
+                                 [optimize_action(optimizer, a) for a in else_actions])
+        case DAMessage(value):
+            return DAMessage(optimizer.expression(value))
+        case DABlock(actions):
+            return DABlock([optimize_action(optimizer, a) for a in actions])
+        case _:
+            return action
+
+
+def optimize_option(optimizer: screept_optimizer.Optimizer, option: Option) -> Option:
+    condition = None if option.condition is None else optimizer.expression(option.condition)
+    return Option(option.id, optimizer.expression(option.text),
+                  [optimize_action(optimizer, a) for a in option.actions], condition)
+
+
+def optimize_dialog(optimizer: screept_optimizer.Optimizer, dialog: Dialog) -> Dialog:
+    return Dialog(dialog.id, optimizer.expression(dialog.text),
+                  [optimize_option(optimizer, o) for o in dialog.options])
+
+
+_whitespace = re.compile(rb'\s*')
+_string = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"')
+_scalar = re.compile(rb'[^\s,\]}]+')
+# up to the next bracket outside of strings, unrolled so runs of plain bytes don't backtrack one at a time
+_flat = re.compile(rb'[^"\[\]{}]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"\[\]{}]*)*')
+
+
+def _skip_value(data: bytes, pos: int) -> int:
+    """End of the JSON value at data[pos], only brackets and strings are looked at"""
+    match data[pos:pos + 1]:
+        case b'"':
+            found = _string.match(data, pos)
+            if found is None:
+                raise Exception(f"Unterminated string at {pos}")
+            return found.end()
+        case b'[' | b'{':
+            depth = 1
+            while True:
+                pos = _flat.match(data, pos + 1).end()
+                match data[pos:pos + 1]:
+                    case b'[' | b'{':
+                        depth += 1
+                    case b']' | b'}':
+                        depth -= 1
+                        if not depth:
+                            return pos + 1
+                    case _:
+                        raise Exception(f"Unterminated value at {pos}")
+        case _:
+            found = _scalar.match(data, pos)
+            if found is None:
+                raise Exception(f"Expected a value at {pos}")
+            return found.end()
+
+
+def index_object(data: bytes, pos: int = 0, nested: Optional[dict[str, Optional[dict]]] = None
+                 ) -> dict[str, tuple[int, int]]:
+    """Byte span of the value of each key of the JSON object at data[pos]. Values are skipped, not decoded,
+    so they are only checked when their span is. The objects under the keys of `nested` are indexed in the same
+    pass, into nested[key]."""
+    return _index_object(data, pos, nested or {})[0]
+
+
+def _index_object(data: bytes, pos: int, nested: dict[str, Optional[dict]]) -> tuple[dict[str, tuple[int, int]], int]:
+    pos = _whitespace.match(data, pos).end()
+    if data[pos:pos + 1] != b'{':
+        raise Exception(f"Expected an object at {pos}")
+    spans = {}
+    pos = _whitespace.match(data, pos + 1).end()
+    if data[pos:pos + 1] == b'}':
+        return spans, pos + 1
+    while True:
+        found = _string.match(data, pos)
+        if found is None:
+            raise Exception(f"Expected a key at {pos}")
+        key = json.loads(found.group())
+        pos = _whitespace.match(data, found.end()).end()
+        if data[pos:pos + 1] != b':':
+            raise Exception(f"Expected ':' at {pos}")
+        start = _whitespace.match(data, pos + 1).end()
+        if key in nested:
+            nested[key], pos = _index_object(data, start, {})
+        else:
+            pos = _skip_value(data, start)
+        spans[key] = (start, pos)
+        pos = _whitespace.match(data, pos).end()
+        match data[pos:pos + 1]:
+            case b',':
+                pos = _whitespace.match(data, pos + 1).end()
+            case b'}':
+                return spans, pos + 1
+            case _:
+                raise Exception(f"Expected ',' or '}}' at {pos}")
+
+
+class LazyDialogs(Mapping[str, Dialog]):
+    """The dialogs of a game file, each decoded the first time it is looked up. Until then a dialog is only the
+    byte span of its JSON (or of its pickle in a bundle), sliced with `read` from the data already in memory."""
+
+    def __init__(self, spans: dict[str, tuple[int, int]], read: Callable[[int, int], bytes],
+                 decode: Callable[[bytes], Dialog]):
+        self.spans = spans
+        self._read = read
+        self._decode = decode
+        self._parsed: dict[str, Dialog] = {}
+
+    def __getitem__(self, key: str) -> Dialog:
+        dialog = self._parsed.get(key)
+        if dialog is None:
+            dialog = self._parsed[key] = self._decode(self._read(*self.spans[key]))
+        return dialog
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.spans
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.spans)
+
+    def __len__(self) -> int:
+        return len(self.spans)
+
+    @property
+    def parsed(self) -> int:
+        return len(self._parsed)
+
+
+def load_game_data(data: bytes, optimize: bool = True, output_size: int = 1000, seed: Optional[int] = None,
+                   lazy: bool = False) -> GameDefinition:
+    """A game from its JSON. With `lazy`, dialogs are parsed from their spans of data when first visited, and
+    removed_nodes grows as they are: until then it only counts what the optimizer did to the vars and procedures."""
+    # with lazy, the dialogs are indexed on the way
+    nested = {'dialogs': None} if lazy else {}
+    top = index_object(data, nested=nested)
+    game_state = json.loads(data[slice(*top['gameState'])])
+    # print(data.keys())
+    env = game_state['screeptEnv']
+    dialog_stack = DialogStack(game_state['dialogStack'])
+    variables = (dict(map(process_var, env['vars'].items())))
+    procedures = (dict(map(process_procedure, env['procedures'].items())))
+    # pprint(procedures)
+    optimizer = screept_optimizer.Optimizer()
+    if optimize:
+        variables = {name: optimizer.value(v) for name, v in variables.items()}
+        procedures = {name: optimizer.statement(s) for name, s in procedures.items()}
+    # the game's own vars get slots too, names computed at run time don't
+    screept.resolve_names([screept.IdentifierLiteral(name) for name in variables] + list(variables.values()) +
+                          list(procedures.values()))
+    environment: screept.Environment = screept.Environment(screept.SlotVars(variables), procedures,
+                                                             screept.RingBufferSink(output_size), screept.Rng(seed))
+    # pprint(environment)
+    game = GameDefinition(GameState(environment, dialog_stack), {}, optimizer.removed)
+
+    def prepare(dialog: Dialog) -> Dialog:
+        if optimize:
+            dialog = optimize_dialog(optimizer, dialog)
+            game.removed_nodes = optimizer.removed
+        # late slots are fine, SlotVars grows to fit them
+        screept.resolve_names(dialog)
+        return dialog
+
+    if lazy:
+        game.dialogs = LazyDialogs(nested['dialogs'], lambda start, end: data[start:end],
+                                   lambda raw: prepare(parse_dialog(json.loads(raw))))
+    else:
+        raw_dialogs = json.loads(data[slice(*top['dialogs'])])
         # pprint(dialogs)
-        variables = (dict(map(process_var, env['vars'].items())))
-        procedures = (dict(map(process_procedure, env['procedures'].items())))
-        # pprint(procedures)
-        environment: screept.Environment = screept.Environment(variables, procedures, [])
-        # pprint(environment)
+        game.dialogs = {name: prepare(parse_dialog(d)) for name, d in raw_dialogs.items()}
+    return game
 
-        return GameDefinition(GameState(environment, dialog_stack), dict(dialogs))
+
+def fork_game(game: GameDefinition, output: list[str] | screept.OutputSink, seed: Optional[int] = None,
+              max_depth: Optional[int] = None, max_cycle: int = 0) -> GameDefinition:
+    """A new playthrough from where the game is, sharing its dialogs. Values are immutable, so a shallow copy of
+    the vars is a copy of the state; procedure ASTs are shared too and only the dict is the copy's, PROC can
+    replace entries."""
+    env = game.game_state.environment
+    environment = screept.Environment(screept.SlotVars(env.vars), dict(env.procedures), output, screept.Rng(seed))
+    stack = DialogStack(game.game_state.dialog_stack, max_depth, max_cycle)
+    if max_cycle:
+        stack.compact()
+    return GameDefinition(GameState(environment, stack), game.dialogs, game.removed_nodes)
+
+
+def load_game(title: str, optimize: bool = True, output_size: int = 1000, seed: Optional[int] = None,
+              lazy: bool = True, bundle: bool = True, prewarm: int = 0) -> GameDefinition:
+    """From data/<title>.bundle when it was compiled from the current data/<title>.json, see dialogs_bundle.
+    With `prewarm`, the dialogs that many hops from the current one are decoded and compiled, see dialogs_graph."""
+    path = "data/" + title + ".json"
+    with open(path, "rb") as f:
+        data = f.read()
+    game = None
+    if bundle and optimize:
+        import dialogs_bundle
+        game = dialogs_bundle.load_bundle(dialogs_bundle.bundle_path(title), data, output_size, seed,
+                                          sys.modules[__name__])
+        if game is not None and not lazy:
+            game.dialogs = dict(game.dialogs)
+    if game is None:
+        game = load_game_data(data, optimize, output_size, seed, lazy)
+    if prewarm:
+        import dialogs_graph
+        dialogs_graph.prewarm(game, prewarm)
+    return game
 
 
 def get_split_string_on_nl(expr: screept.Expression, env: screept.Environment) -> list[str]:
-    return screept.evaluate_expression(expr, env).get_string().split('<nl>')
+    return evaluate_expression(expr, env).get_string().split('<nl>')
 
 
 def get_status_line(env: screept.Environment):
     if '__statusLine' in env.vars:
-        parsed = screept.expr_parser.parse('__statusLine()')
-        return screept.evaluate_expression(parsed, env).get_string()
+        # the parse cache hands back the same AST every time, so its compiled closure is reused too
+        return evaluate_expression(screept.parse_expression('__statusLine()'), env).get_string()
     else:
         return ""
 
@@ -226,82 +497,309 @@ def is_option_visible(env: screept.Environment, option: Option) -> bool:
         case None:
             return True
         case ex:
-            return screept.evaluate_expression(ex, env).get_number() != 0
+            return evaluate_expression(ex, env).get_number() != 0
 
 
 def get_visible_options(options: Sequence[Option], env: screept.Environment) -> Sequence[Option]:
     return list(filter(partial(is_option_visible, env), options))
 
 
+def get_dialog_visible_options(dialog: Dialog, env: screept.Environment) -> Sequence[Option]:
+    return get_visible_options(dialog.options, env)
+
+
 def show_option(option: Option, env: screept.Environment):
-    text = screept.evaluate_expression(option.text, env).get_string()
+    text = evaluate_expression(option.text, env).get_string()
     return text
 
 
-def show_dialog(dialogs: Mapping[str, Dialog], dialog_id: str, env: screept.Environment):
+@dataclass
+class RenderedDialog:
+    status_line: str
+    text: list[str]
+    # texts of the visible options, the first is choice 1
+    options: list[str]
+
+
+def render_dialog(dialogs: Mapping[str, Dialog], dialog_id: str, env: screept.Environment) -> RenderedDialog:
     dialog = dialogs[dialog_id]
-    # pprint(dialog)
     status_line = get_status_line(env)
-    if status_line:
-        print(status_line)
-    print("\n".join(get_split_string_on_nl(dialog.text, env)))
-    visible_options = get_visible_options(dialog.options, env)
-    for i, opt in enumerate(visible_options):
-        print(i + 1, show_option(opt, env))
+    text = get_split_string_on_nl(dialog.text, env)
+    visible_options = get_dialog_visible_options(dialog, env)
+    return RenderedDialog(status_line, text, [show_option(opt, env) for opt in visible_options])
+
+
+def show_dialog(dialogs: Mapping[str, Dialog], dialog_id: str, env: screept.Environment):
+    rendered = render_dialog(dialogs, dialog_id, env)
+    # pprint(dialog)
+    if rendered.status_line:
+        print(rendered.status_line)
+    print("\n".join(rendered.text))
+    for i, text in enumerate(rendered.options):
+        print(i + 1, text)
 
     # pprint(env.vars)
 
 
-def execute_action(game: GameDefinition, action: DialogAction):
+def execute_action(game: GameDefinition, action: DialogAction, show: Callable[[str], None] = print):
     env = game.game_state.environment
     match action:
         case DAGoDialog(dialog_id):
-            game.game_state.dialog_stack.insert(0, dialog_id)
+            game.game_state.dialog_stack.push(dialog_id)
         case DAGoBack():
-            game.game_state.dialog_stack.pop(0)
+            game.game_state.dialog_stack.pop()
         case DAScreept(value):
-            screept.run_statement(value, env)
+            run_statement(value, env)
         case DAMessage(value):
-            print("MESSAGE:")
-            print(screept.evaluate_expression(value, env).get_string())
+            show("MESSAGE:")
+            show(evaluate_expression(value, env).get_string())
         case DAConditional(condition, then_actions, else_actions):
-            if screept.evaluate_expression(condition, env).get_number():
+            if evaluate_expression(condition, env).get_number():
                 for a in then_actions:
-                    execute_action(game, a)
+                    execute_action(game, a, show)
             else:
                 for a in else_actions:
-                    execute_action(game, a)
+                    execute_action(game, a, show)
         case _:
             pprint(action)
             raise Exception("NO handler for ACTION" + repr(action))
 
 
-def loop(gd):
-    dialog = gd.dialogs[gd.game_state.dialog_stack[0]]
-    show_dialog(gd.dialogs, gd.game_state.dialog_stack[0],
-                gd.game_state.environment)
-    selected = input("Choose option")
-    try:
-        opt_no = int(selected)
-        option = get_visible_options(dialog.options, gd.game_state.environment)[opt_no - 1]
-
-
-    except:
-        loop(gd)
-    else:
-        pprint(option)
+def stdin_choices(prompt: str = "Choose option") -> Iterator[str]:
+    while True:
+        try:
+            yield input(prompt)
+        except EOFError:
+            return
+
+
+def queue_choices(choices: queue.Queue) -> Iterator[str]:
+    """Choices put on the queue by another thread, until it puts None"""
+    while (choice := choices.get()) is not None:
+        yield choice
+
+
+@dataclass(slots=True)
+class TraceTurn:
+    """One turn of a played game, see dialogs_trace"""
+    dialog: str
+    # id of the chosen option
+    option: str
+    # RND draws taken by the actions
+    draws: int
+    errors: int
+    # ns per action
+    timings: list[int]
+
+
+class GameDriver:
+    """Plays a game from a stream of choices ("1" for the first visible option), one turn per choice, in a loop
+    rather than by recursion, so a session can go on for any number of turns. Headless, nothing is printed and
+    dialogs are not rendered, only the visible options are worked out; that is for replaying choice scripts in
+    soak and throughput tests. Turns are appended to `trace` when one is given. Each action runs with `fuel` and
+    `timeout` as its limits, so a script that loops fails as an action error instead of hanging the game.
+    With `prewarm`, the dialogs that many hops from the current one are compiled whenever it changes, on `graph`
+    when one is given (a dialogs_graph.DialogGraph of the game's dialogs, which drivers can share)."""
+
+    def __init__(self, game: GameDefinition, choices: Iterable[str | int] | queue.Queue | None = None,
+                 headless: bool = False, trace: Optional[list[TraceTurn]] = None, fuel: Optional[int] = ACTION_FUEL,
+                 timeout: Optional[float] = None, prewarm: int = 0, graph=None):
+        self.game = game
+        if choices is None:
+            choices = stdin_choices()
+        elif isinstance(choices, queue.Queue):
+            choices = queue_choices(choices)
+        self.choices = iter(choices)
+        self.headless = headless
+        self.turns = 0
+        self.invalid = 0
+        self.errors = 0
+        self.trace = trace
+        self.fuel = fuel
+        self.timeout = timeout
+        self.prewarm = prewarm
+        if prewarm and graph is None:
+            import dialogs_graph
+            graph = dialogs_graph.DialogGraph(game.dialogs)
+        self.graph = graph
+        # the dialog the last prewarm was around
+        self.warmed: Optional[str] = None
+
+    def show(self, text: str) -> None:
+        if not self.headless:
+            print(text)
+
+    def action_error(self, e: Exception) -> None:
+        if not self.headless:
+            print("Action Error: " + str(e))
+            pprint(self.game.game_state.environment)
+
+    def choose(self, dialog: Dialog, selected: str | int) -> Optional[Option]:
+        options = get_dialog_visible_options(dialog, self.game.game_state.environment)
+        try:
+            opt_no = int(selected)
+        except ValueError:
+            return None
+        # 0 and negative numbers would count from the end of the list
+        return options[opt_no - 1] if 1 <= opt_no <= len(options) else None
+
+    def step(self, selected: str | int) -> bool:
+        """Plays one choice in the current dialog, False if it was not a valid option"""
+        state = self.game.game_state
+        dialog = self.game.dialogs[state.dialog_stack[0]]
+        option = self.choose(dialog, selected)
+        if option is None:
+            self.invalid += 1
+            return False
+        if not self.headless:
+            pprint(option)
+        trace = self.trace
+        if trace is not None:
+            drawn, errors, timings = state.environment.rng.drawn, self.errors, []
         for action in option.actions:
+            if trace is not None:
+                start = time.perf_counter_ns()
             try:
-                execute_action(gd, action)
+                with screept_compiler.limited(self.fuel, self.timeout):
+                    execute_action(self.game, action, self.show)
             except Exception as e:
-                print("Action Error: "+str(e))
-                pprint(gd.game_state.environment)
-        loop(gd)
+                self.errors += 1
+                self.action_error(e)
+            if trace is not None:
+                timings.append(time.perf_counter_ns() - start)
+        if trace is not None:
+            trace.append(TraceTurn(dialog.id, option.id, state.environment.rng.drawn - drawn, self.errors - errors,
+                                   timings))
+        self.turns += 1
+        if self.prewarm and state.dialog_stack and state.dialog_stack[0] != self.warmed:
+            self.warmed = state.dialog_stack[0]
+            self.graph.prewarm(state.dialog_stack[:1], self.prewarm)
+        return True
+
+    def run(self) -> int:
+        """Plays until the choices run out or the dialog stack is empty, returns the number of turns played"""
+        state = self.game.game_state
+        while state.dialog_stack:
+            if not self.headless:
+                show_dialog(self.game.dialogs, state.dialog_stack[0], state.environment)
+            try:
+                selected = next(self.choices)
+            except StopIteration:
+                break
+            self.step(selected)
+        return self.turns
+
+
+def loop(gd):
+    GameDriver(gd).run()
+
+
+def random_choices(game: GameDefinition, rng, count: int) -> list[str]:
+    """A choice script: `count` turns of picking a random visible option, played on a copy of the game"""
+    driver = GameDriver(deepcopy(game), [], headless=True)
+    state = driver.game.game_state
+    script = []
+    while len(script) < count and state.dialog_stack:
+        options = get_dialog_visible_options(driver.game.dialogs[state.dialog_stack[0]], state.environment)
+        if not options:
+            break
+        script.append(str(rng.randrange(len(options)) + 1))
+        driver.step(script[-1])
+    return script
+
+
+def benchmark_headless(title: str = "customGame", turns: int = 100000, seed: int = 0):
+    """Replays a random choice script headless; far more turns than the recursive loop could take"""
+    import random
+    game = load_game(title, seed=seed)
+    script = random_choices(game, random.Random(seed), turns)
+    driver = GameDriver(game, script, headless=True)
+    start = time.perf_counter()
+    played = driver.run()
+    elapsed = time.perf_counter() - start
+    assert played == len(script) and driver.invalid == 0
+    print(f"{title}: {played} turns in {elapsed:.2f}s, {played / elapsed:.0f} turns/s, {driver.errors} action errors")
+
+
+def benchmark_lazy(copies: int = 200):
+    """Time to first render and memory held, eager and lazy, on fable with its dialogs copied to make a big book"""
+    import io
+    import os
+    import tempfile
+    import tracemalloc
+    from contextlib import redirect_stdout
+    with open("data/fable.json") as f:
+        data = json.load(f)
+    data['dialogs'] = {f"{name}{n or ''}": dict(d, id=f"{name}{n or ''}") for n in range(copies)
+                       for name, d in data['dialogs'].items()}
+    path = os.path.join(tempfile.mkdtemp(), "book.json")
+    with open(path, "w") as f:
+        json.dump(data, f)
+    def first_render(lazy: bool) -> GameDefinition:
+        with open(path, "rb") as f:
+            game = load_game_data(f.read(), lazy=lazy)
+        with redirect_stdout(io.StringIO()):
+            show_dialog(game.dialogs, game.game_state.dialog_stack[0], game.game_state.environment)
+        return game
+
+    for lazy in [False, True]:
+        start = time.perf_counter()
+        first_render(lazy)
+        elapsed = time.perf_counter() - start
+        # again for the memory, tracemalloc slows everything down
+        tracemalloc.start()
+        game = first_render(lazy)
+        held, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{len(game.dialogs)} dialogs, {'lazy' if lazy else 'eager'}: first render after {elapsed * 1000:.1f}ms, "
+              f"{held / 1e6:.2f} MB held, peak {peak / 1e6:.2f} MB")
+        del game
+    os.remove(path)
+
+
+def benchmark_stack(turns: int = 200000, seed: int = 0):
+    """Walking deeper and back over a long playthrough: the list it used to be, DialogStack, and DialogStack
+    bounded and compacting; then the size of customGame's saved stack compacted"""
+    import random
+    rng = random.Random(seed)
+    moves = [rng.choice(["start", "farm", "forest", "menu"]) if rng.random() < 0.6 else None for _ in range(turns)]
+
+    def play_list() -> int:
+        stack = ["start"]
+        for move in moves:
+            if move is not None:
+                stack.insert(0, move)
+            elif len(stack) > 1:
+                stack.pop(0)
+        return len(stack)
+
+    def play_stack(stack: DialogStack) -> int:
+        for move in moves:
+            if move is not None:
+                stack.push(move)
+            elif len(stack) > 1:
+                stack.pop()
+        return len(stack)
+
+    for name, play in [("list", play_list), ("DialogStack", lambda: play_stack(DialogStack(["start"]))),
+                       ("DialogStack(256, 4)", lambda: play_stack(DialogStack(["start"], 256, 4)))]:
+        start = time.perf_counter()
+        depth = play()
+        elapsed = time.perf_counter() - start
+        print(f"{name:>20}: {turns / elapsed / 1e6:.2f}M moves/s, {depth} deep at the end")
+    with open("data/customGame.json") as f:
+        saved = json.load(f)['gameState']['dialogStack']
+    stack = DialogStack(saved, max_cycle=4)
+    stack.compact()
+    assert stack[0] == saved[0]
+    print(f"customGame stack: {len(saved)} entries saved, {len(stack)} compacted: {list(stack)}")
 
 
 if __name__ == "__main__":
     # game_definition = load_game("fable")
-    game_definition = load_game("customGame")
+    # not lazy, so removed_nodes covers the dialogs too
+    game_definition = load_game("customGame", lazy=False)
+    print("Optimizer removed", game_definition.removed_nodes, "nodes")
     loop(game_definition)
     # show_dialog(game_definition.dialogs, game_definition.game_state.dialog_stack[0],
     #             game_definition.game_state.environment)
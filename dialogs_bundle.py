@@ -0,0 +1,221 @@
+"""
+Precompiled game bundles
+================
+
+``python dialogs_bundle.py compile-game fable`` turns data/fable.json into
+data/fable.bundle: the game parsed and optimized once, so worker processes
+load pickled ASTs instead of running the JSON through the ``match``-based
+parsers again.
+
+A bundle is a fixed header (magic, format version, SHA-256 of the JSON it was
+compiled from and of the sources of the modules that compiled it, where the
+index is) followed by pickles: one for the vars,
+procedures and dialog stack, one per dialog, and the index of their byte
+spans. It is read through mmap and dialogs are unpickled the first time they
+are visited, so processes share the pages and only pay for what they show.
+``dialogs.load_game`` uses the bundle when its checksum matches the JSON and
+the code, so editing the game, the parser or the optimizer makes it stale.
+Unpickling only accepts the dialog and syntax classes a bundle is made of.
+"""
+import argparse
+import functools
+import hashlib
+import importlib
+import io
+import mmap
+import os
+import pickle
+import struct
+import sys
+import time
+from types import ModuleType
+from typing import Optional
+
+import screept
+import screept_snapshot
+
+MAGIC = b"SCRPTGAM"
+VERSION = 1
+
+# magic, version, SHA-256 of the source JSON and the compiler, index offset, index length
+_header = struct.Struct("<8sH32sQQ")
+
+# besides dialogs, the modules whose code decides what a bundle holds: the parser and AST classes, the optimizer
+compiler_modules = ["screept", "screept_optimizer"]
+
+
+# what dialogs are made of, besides screept_snapshot.syntax_classes
+dialog_classes = ["Dialog", "Option", "DAGoBack", "DAGoDialog", "DAScreept", "DAConditional", "DAMessage", "DABlock"]
+
+
+def bundle_path(title: str) -> str:
+    return "data/" + title + ".bundle"
+
+
+@functools.lru_cache
+def _allowed(dialogs: ModuleType) -> dict[str, dict[str, type]]:
+    # the dialogs classes of the module given, which may be running as __main__
+    return {"screept": {cls.__name__: cls for cls in screept_snapshot.syntax_classes},
+            "dialogs": {name: getattr(dialogs, name) for name in dialog_classes}}
+
+
+class _Unpickler(pickle.Unpickler):
+    def __init__(self, data, dialogs: ModuleType):
+        super().__init__(data)
+        self._allowed = _allowed(dialogs)
+
+    def find_class(self, module: str, name: str):
+        found = self._allowed.get(module, {}).get(name)
+        if found is not None:
+            return found
+        raise pickle.UnpicklingError(f"{module}.{name} is not allowed in a bundle")
+
+
+def _loads(data, dialogs: ModuleType):
+    return _Unpickler(io.BytesIO(data), dialogs).load()
+
+
+@functools.lru_cache
+def _sources_digest(paths: tuple[str, ...]) -> bytes:
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.digest()
+
+
+def _digest(source: bytes, dialogs: ModuleType) -> bytes:
+    """SHA-256 of the JSON and of the sources of the compiler modules"""
+    modules = [importlib.import_module(name) for name in compiler_modules] + [dialogs]
+    return hashlib.sha256(source + _sources_digest(tuple(m.__file__ for m in modules))).digest()
+
+
+def compile_game(title: str, path: Optional[str] = None) -> str:
+    import dialogs
+    with open("data/" + title + ".json", "rb") as f:
+        data = f.read()
+    game = dialogs.load_game_data(data)
+    env = game.game_state.environment
+    state = pickle.dumps((dict(env.vars), dict(env.procedures), list(game.game_state.dialog_stack), game.removed_nodes),
+                         protocol=pickle.HIGHEST_PROTOCOL)
+    blobs = [state] + [pickle.dumps(d, protocol=pickle.HIGHEST_PROTOCOL) for d in game.dialogs.values()]
+    spans = []
+    offset = _header.size
+    for blob in blobs:
+        spans.append((offset, offset + len(blob)))
+        offset += len(blob)
+    index = pickle.dumps({"state": spans[0], "dialogs": dict(zip(game.dialogs, spans[1:]))},
+                         protocol=pickle.HIGHEST_PROTOCOL)
+    path = path or bundle_path(title)
+    # written aside and renamed, a worker starting meanwhile sees the old bundle or the new one, never half of one
+    with open(path + ".tmp", "wb") as f:
+        f.write(_header.pack(MAGIC, VERSION, _digest(data, dialogs), offset, len(index)))
+        f.writelines(blobs)
+        f.write(index)
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def load_bundle(path: str, source: bytes, output_size: int = 1000, seed: Optional[int] = None,
+                dialogs: Optional[ModuleType] = None):
+    """The game in the bundle at path, None if there is none or it wasn't compiled from `source`.
+    `dialogs` is the module whose classes to build, the caller's own when that is running as __main__."""
+    if dialogs is None:
+        import dialogs
+    try:
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size < _header.size:
+                return None
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except FileNotFoundError:
+        return None
+    magic, version, digest, index_offset, index_length = _header.unpack_from(mapped)
+    if magic != MAGIC:
+        raise Exception(path + " is not a game bundle")
+    if version != VERSION or digest != _digest(source, dialogs):
+        return None
+    view = memoryview(mapped)
+    index = _loads(view[index_offset:index_offset + index_length], dialogs)
+    variables, procedures, dialog_stack, removed_nodes = _loads(view[slice(*index["state"])], dialogs)
+    # the game's own vars get slots too, names computed at run time don't
+    screept.resolve_names([screept.IdentifierLiteral(name) for name in variables] + list(variables.values()) +
+                          list(procedures.values()))
+
+    def decode(blob):
+        dialog = _loads(blob, dialogs)
+        screept.resolve_names(dialog)
+        return dialog
+
+    # the slices keep the map open for as long as the dialogs may need it
+    lazy = dialogs.LazyDialogs(index["dialogs"], lambda start, end: view[start:end], decode)
+    environment = screept.Environment(screept.SlotVars(variables), procedures, screept.RingBufferSink(output_size),
+                                      screept.Rng(seed))
+    return dialogs.GameDefinition(dialogs.GameState(environment, dialogs.DialogStack(dialog_stack)), lazy,
+                                  removed_nodes)
+
+
+#
+
+
+def test():
+    import tempfile
+    import dialogs
+    for title in ["customGame", "fable"]:
+        with open("data/" + title + ".json", "rb") as f:
+            data = f.read()
+        path = compile_game(title, os.path.join(tempfile.mkdtemp(), title + ".bundle"))
+        game = load_bundle(path, data, seed=1)
+        reference = dialogs.load_game(title, seed=1, lazy=False, bundle=False)
+        assert dict(game.dialogs) == dict(reference.dialogs)
+        assert game.game_state == reference.game_state
+        assert game.removed_nodes == reference.removed_nodes
+        # any change to the JSON makes the bundle stale
+        assert load_bundle(path, data + b" ") is None
+        # and so does a change to the compiler
+        compiler_modules.append("dialogs_graph")
+        try:
+            assert load_bundle(path, data) is None
+        finally:
+            compiler_modules.pop()
+        os.remove(path)
+    for body in [b"cdialogs\npartial\n.", b"cscreept\nLark\n.", b"cscreept\nFileSink\n.", b"cdialogs\nGameDriver\n."]:
+        try:
+            _loads(body, dialogs)
+        except pickle.UnpicklingError:
+            pass
+        else:
+            assert False
+    print("OK")
+
+
+def benchmark(title: str = "fable", iterations: int = 20):
+    """A worker's startup: loading the game and looking up the first dialog"""
+    import dialogs
+    path = compile_game(title)
+    for name, bundle in [("JSON", False), ("bundle", True)]:
+        start = time.perf_counter()
+        for _ in range(iterations):
+            game = dialogs.load_game(title, bundle=bundle)
+            game.dialogs[game.game_state.dialog_stack[0]]
+        print(f"{title} from {name}: {(time.perf_counter() - start) / iterations * 1000:.2f}ms")
+    print(f"{os.path.getsize(path)} bytes bundle, {os.path.getsize('data/' + title + '.json')} bytes JSON")
+
+
+def main(argv: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(description="Precompile data/<title>.json into data/<title>.bundle")
+    commands = parser.add_subparsers(dest="command", required=True)
+    compile_command = commands.add_parser("compile-game")
+    compile_command.add_argument("titles", nargs="+")
+    args = parser.parse_args(argv)
+    for title in args.titles:
+        start = time.perf_counter()
+        path = compile_game(title)
+        print(f"{path}: {os.path.getsize(path)} bytes in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main()
+    else:
+        test()
+        benchmark()
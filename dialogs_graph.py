@@ -0,0 +1,206 @@
+"""
+Dialog graph
+================
+
+Where each dialog's options can go with ``DAGoDialog``, nested
+``DAConditional`` and ``DABlock`` actions included; ``DAGoBack`` only returns
+to a dialog already on the stack, so it adds no edges. The edges of a dialog
+are worked out the first time they are needed, so with ``LazyDialogs`` a walk
+of a few hops only decodes the dialogs it passes.
+
+``unreachable`` and ``dangling`` check a whole game, e.g. after editing it:
+dialogs no path from the dialog stack leads to, and destinations that are not
+dialogs. ``prewarm`` decodes and compiles the dialogs within some hops of the
+current one, which is what makes the first visit of a dialog slower than the
+next ones. ``python dialogs_graph.py <title>...`` prints the analysis.
+"""
+import sys
+import time
+from collections import deque
+from collections.abc import Iterable, Iterator, Mapping
+from typing import Optional
+
+import dialogs
+import screept
+import screept_compiler
+from dialogs import Dialog, DialogAction, DAGoDialog, DAConditional, DABlock, DAScreept, DAMessage, GameDefinition
+
+
+def destinations(actions: Iterable[DialogAction]) -> Iterator[str]:
+    for action in actions:
+        match action:
+            case DAGoDialog(dialog_id):
+                yield dialog_id
+            case DAConditional(_, then_actions, else_actions):
+                yield from destinations(then_actions)
+                yield from destinations(else_actions)
+            case DABlock(actions):
+                yield from destinations(actions)
+
+
+def _nodes(actions: Iterable[DialogAction]) -> Iterator:
+    """The screept ASTs of the actions"""
+    for action in actions:
+        match action:
+            case DAScreept(value) | DAMessage(value):
+                yield value
+            case DAConditional(condition, then_actions, else_actions):
+                yield condition
+                yield from _nodes(then_actions)
+                yield from _nodes(else_actions)
+            case DABlock(actions):
+                yield from _nodes(actions)
+
+
+class DialogGraph:
+    def __init__(self, dialogs: Mapping[str, Dialog]):
+        self.dialogs = dialogs
+        self._edges: dict[str, tuple[str, ...]] = {}
+        self._warm: set[str] = set()
+
+    def edges(self, dialog_id: str) -> tuple[str, ...]:
+        """Destinations of the dialog's options, in order and without repeats"""
+        found = self._edges.get(dialog_id)
+        if found is None:
+            dialog = self.dialogs[dialog_id]
+            found = self._edges[dialog_id] = tuple(dict.fromkeys(
+                d for option in dialog.options for d in destinations(option.actions)))
+        return found
+
+    def within(self, roots: Iterable[str], hops: Optional[int] = None) -> dict[str, int]:
+        """Dialog -> fewest hops from the roots, for the dialogs at most `hops` away (any number when None).
+        Destinations that are not dialogs are left out."""
+        found = {}
+        pending = deque()
+        for root in roots:
+            if root in self.dialogs and root not in found:
+                found[root] = 0
+                pending.append(root)
+        while pending:
+            dialog_id = pending.popleft()
+            distance = found[dialog_id]
+            if hops is not None and distance >= hops:
+                continue
+            for destination in self.edges(dialog_id):
+                if destination in self.dialogs and destination not in found:
+                    found[destination] = distance + 1
+                    pending.append(destination)
+        return found
+
+    def unreachable(self, roots: Iterable[str]) -> list[str]:
+        reachable = self.within(roots)
+        return [dialog_id for dialog_id in self.dialogs if dialog_id not in reachable]
+
+    def dangling(self) -> list[tuple[str, str]]:
+        """(dialog, destination) for every destination that is not a dialog"""
+        return [(dialog_id, destination) for dialog_id in self.dialogs for destination in self.edges(dialog_id)
+                if destination not in self.dialogs]
+
+    def prewarm(self, roots: Iterable[str], hops: int = 2) -> int:
+        """Decodes the dialogs within `hops` of the roots and compiles their expressions and statements, returns
+        how many dialogs were new to it"""
+        warmed = 0
+        for dialog_id in self.within(roots, hops):
+            if dialog_id in self._warm:
+                continue
+            dialog = self.dialogs[dialog_id]
+            screept_compiler.compile_cached(dialog.text)
+            for option in dialog.options:
+                screept_compiler.compile_cached(option.text)
+                if option.condition is not None:
+                    screept_compiler.compile_cached(option.condition)
+                for node in _nodes(option.actions):
+                    screept_compiler.compile_cached(node)
+            self._warm.add(dialog_id)
+            warmed += 1
+        return warmed
+
+
+def prewarm(game: GameDefinition, hops: int = 2) -> DialogGraph:
+    """A graph of the game's dialogs, warmed around the current dialog"""
+    graph = DialogGraph(game.dialogs)
+    graph.prewarm(game.game_state.dialog_stack[:1], hops)
+    return graph
+
+
+#
+
+
+def test():
+    from dialogs import Option
+    text = screept.ValueString("")
+    game = {
+        "a": Dialog("a", text, [Option("1", text, [DAGoDialog("b")]),
+                                Option("2", text, [DAConditional(text, [DABlock([DAGoDialog("c")])],
+                                                                 [DAGoDialog("missing")])])]),
+        "b": Dialog("b", text, [Option("1", text, [DAGoDialog("a")])]),
+        "c": Dialog("c", text, [Option("1", text, [DAGoDialog("d")])]),
+        "d": Dialog("d", text, []),
+        "island": Dialog("island", text, [Option("1", text, [DAGoDialog("a")])]),
+    }
+    graph = DialogGraph(game)
+    assert graph.edges("a") == ("b", "c", "missing")
+    assert graph.within(["a"], 1) == {"a": 0, "b": 1, "c": 1}
+    assert graph.unreachable(["a"]) == ["island"]
+    assert graph.dangling() == [("a", "missing")]
+    # lazily loaded, a short walk decodes only what it passes
+    for title in ["customGame", "fable"]:
+        lazy = dialogs.load_game(title, bundle=False)
+        reference = dialogs.load_game(title, lazy=False, bundle=False)
+        graph = DialogGraph(lazy.dialogs)
+        graph.prewarm(lazy.game_state.dialog_stack[:1], 1)
+        assert lazy.dialogs.parsed <= 1 + len(graph.edges(lazy.game_state.dialog_stack[0]))
+        full = DialogGraph(reference.dialogs)
+        assert graph.unreachable(lazy.game_state.dialog_stack) == full.unreachable(reference.game_state.dialog_stack)
+        # a driver warms up around wherever the player goes
+        driver = dialogs.GameDriver(lazy, [], headless=True, prewarm=1, graph=graph)
+        stack = lazy.game_state.dialog_stack
+        for _ in range(20):
+            if not stack or not driver.step("1"):
+                break
+            assert not stack or set(graph.within(stack[:1], 1)) <= graph._warm
+    print("OK")
+
+
+def benchmark(title: str = "fable", hops: int = 2):
+    """Slowest first render of the dialogs near the start, cold and after prewarm; each run loads the game anew"""
+    import io
+    from contextlib import redirect_stdout
+    # builds the Lark parser get_status_line needs outside of the timings
+    screept.parse_expression('__statusLine()')
+    reference = dialogs.load_game(title, lazy=False)
+    nearby = DialogGraph(reference.dialogs).within(reference.game_state.dialog_stack[:1], hops)
+    for warm in [False, True]:
+        screept_compiler._compiled.clear()
+        start = time.perf_counter()
+        game = dialogs.load_game(title, prewarm=hops if warm else 0)
+        loaded = time.perf_counter() - start
+        state = game.game_state
+        slowest = 0.0
+        with redirect_stdout(io.StringIO()):
+            for dialog_id in nearby:
+                start = time.perf_counter()
+                dialogs.show_dialog(game.dialogs, dialog_id, state.environment)
+                slowest = max(slowest, time.perf_counter() - start)
+        print(f"{title} {'prewarmed' if warm else 'cold'}: {len(nearby)} dialogs within {hops} hops, "
+              f"slowest first render {slowest * 1000:.2f}ms, loaded in {loaded * 1000:.2f}ms")
+
+
+def main(titles: list[str]):
+    for title in titles:
+        game = dialogs.load_game(title)
+        graph = DialogGraph(game.dialogs)
+        edges = sum(len(graph.edges(dialog_id)) for dialog_id in game.dialogs)
+        print(f"{title}: {len(game.dialogs)} dialogs, {edges} edges")
+        for dialog_id in graph.unreachable(game.game_state.dialog_stack):
+            print("  unreachable:", dialog_id)
+        for dialog_id, destination in graph.dangling():
+            print(f"  dangling: {dialog_id} -> {destination}")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(sys.argv[1:])
+    else:
+        test()
+        benchmark()
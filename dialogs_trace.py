@@ -0,0 +1,252 @@
+"""
+Action traces
+================
+
+A ``Trace`` is a played session in a form small enough to attach to a bug
+report: a snapshot of the environment it started from (see
+``screept_snapshot``; the Rng in it is the seed and how far it got), the
+dialog stack, and per turn the dialog, the id of the chosen option, how
+many RND draws its actions took, how many of them failed and how long each
+one ran. ``GameDriver`` records the turns when given ``trace.turns``.
+
+``replay`` plays a trace back against the game's dialogs: no rendering and
+messages go nowhere, so it runs about as fast as the engine does. Actions get
+``dialogs.ACTION_FUEL``, like in ``GameDriver``. Since RND comes from the
+environment's own stream, a replay takes the same path as the session did. It
+raises ``ReplayDiverged`` at the first turn whose option is gone, and with
+``check`` at the first turn where the dialog, the draws or the errors differ or
+the option isn't visible, e.g. after a change to the engine or to the game file.
+
+``python dialogs_trace.py replay <trace>`` replays a saved trace and prints
+its slowest actions.
+"""
+import argparse
+import json
+import struct
+import sys
+import time
+import zlib
+from collections.abc import Mapping
+from dataclasses import dataclass, field
+from typing import Optional
+
+import dialogs
+import screept_compiler
+import screept_snapshot
+from dialogs import (ACTION_FUEL, Dialog, DialogStack, GameDefinition, GameState, TraceTurn, execute_action,
+                     is_option_visible)
+
+MAGIC = b"SCRTRACE"
+VERSION = 2
+
+# magic, version, snapshot length
+_header = struct.Struct("<8sHI")
+
+
+class ReplayDiverged(Exception):
+    pass
+
+
+@dataclass
+class Trace:
+    title: str
+    # screept_snapshot of the environment at the start
+    snapshot: bytes
+    dialog_stack: list[str]
+    turns: list[TraceTurn] = field(default_factory=list)
+    # the limits of the DialogStack
+    max_depth: Optional[int] = None
+    max_cycle: int = 0
+
+    @staticmethod
+    def start(title: str, game: GameDefinition) -> "Trace":
+        state = game.game_state
+        stack = state.dialog_stack
+        return Trace(title, screept_snapshot.dumps(state.environment), list(stack), [], stack.max_depth,
+                     stack.max_cycle)
+
+    def game(self, dialogs: Mapping[str, Dialog]) -> GameDefinition:
+        """The game as it was when the trace started, on the given dialogs"""
+        stack = DialogStack(self.dialog_stack, self.max_depth, self.max_cycle)
+        return GameDefinition(GameState(screept_snapshot.loads(self.snapshot), stack), dialogs, 0)
+
+    def actions(self) -> int:
+        return sum(len(t.timings) for t in self.turns)
+
+    def slowest(self, count: int = 10) -> list[tuple[int, int, int]]:
+        """(ns, turn number, action number in the whole trace) of the slowest actions"""
+        found = []
+        action = 0
+        for n, turn in enumerate(self.turns):
+            for ns in turn.timings:
+                found.append((ns, n, action))
+                action += 1
+        return sorted(found, reverse=True)[:count]
+
+    def dumps(self) -> bytes:
+        names = {name: i for i, name in enumerate(dict.fromkeys(t.dialog for t in self.turns))}
+        body = {"title": self.title, "dialogStack": self.dialog_stack, "maxDepth": self.max_depth,
+                "maxCycle": self.max_cycle, "dialogs": list(names),
+                "turns": [[names[t.dialog], t.option, t.draws, t.errors, t.timings] for t in self.turns]}
+        return (_header.pack(MAGIC, VERSION, len(self.snapshot)) + self.snapshot +
+                zlib.compress(json.dumps(body, separators=(",", ":")).encode()))
+
+    @staticmethod
+    def loads(data: bytes) -> "Trace":
+        magic, version, snapshot_length = _header.unpack_from(data)
+        if magic != MAGIC:
+            raise Exception("Not a dialogs trace")
+        if version != VERSION:
+            raise Exception(f"Unsupported trace version {version}, expected {VERSION}")
+        end = _header.size + snapshot_length
+        body = json.loads(zlib.decompress(memoryview(data)[end:]))
+        names = body["dialogs"]
+        turns = [TraceTurn(names[d], option, draws, errors, timings)
+                 for d, option, draws, errors, timings in body["turns"]]
+        return Trace(body["title"], bytes(data[_header.size:end]), body["dialogStack"], turns, body["maxDepth"],
+                     body["maxCycle"])
+
+    def save(self, path: str) -> None:
+        with open(path, "wb") as f:
+            f.write(self.dumps())
+
+    @staticmethod
+    def load(path: str) -> "Trace":
+        with open(path, "rb") as f:
+            return Trace.loads(f.read())
+
+
+def _ignore(text: str) -> None:
+    pass
+
+
+def replay(trace: Trace, dialogs: Mapping[str, Dialog], check: bool = True,
+           timings: Optional[list[int]] = None) -> GameDefinition:
+    """Plays the trace from its start, returns the game as it ended. Timings of the actions are appended to
+    `timings` when one is given."""
+    game = trace.game(dialogs)
+    state = game.game_state
+    env = state.environment
+    clock = time.perf_counter_ns
+    for n, turn in enumerate(trace.turns):
+        if check and (not state.dialog_stack or state.dialog_stack[0] != turn.dialog):
+            raise ReplayDiverged(f"turn {n}: in {state.dialog_stack[0] if state.dialog_stack else None}, "
+                                 f"expected {turn.dialog}")
+        option = next((o for o in dialogs[turn.dialog].options if o.id == turn.option), None)
+        if option is None:
+            raise ReplayDiverged(f"turn {n} in {turn.dialog}: no option {turn.option!r}")
+        if check and option.condition is not None:
+            # only the chosen option's condition, the others don't change what the turn does
+            with screept_compiler.limited(ACTION_FUEL):
+                visible = is_option_visible(env, option)
+            if not visible:
+                raise ReplayDiverged(f"turn {n} in {turn.dialog}: option {turn.option!r} is not visible")
+        drawn = env.rng.drawn
+        errors = 0
+        for action in option.actions:
+            if timings is not None:
+                start = clock()
+            try:
+                with screept_compiler.limited(ACTION_FUEL):
+                    execute_action(game, action, _ignore)
+            except Exception:
+                errors += 1
+            if timings is not None:
+                timings.append(clock() - start)
+        if check and (env.rng.drawn - drawn, errors) != (turn.draws, turn.errors):
+            raise ReplayDiverged(f"turn {n} in {turn.dialog}: {env.rng.drawn - drawn} draws and {errors} errors, "
+                                 f"expected {turn.draws} and {turn.errors}")
+    return game
+
+
+def record(title: str, game: GameDefinition, choices) -> Trace:
+    """Plays the choices headless on the game, recording them"""
+    trace = Trace.start(title, game)
+    dialogs.GameDriver(game, choices, headless=True, trace=trace.turns).run()
+    return trace
+
+
+#
+
+
+def test():
+    import random
+    import screept
+    for title in ["customGame", "fable"]:
+        game = dialogs.load_game(title, seed=3)
+        script = dialogs.random_choices(game, random.Random(3), 300)
+        reference = dialogs.load_game(title, seed=3)
+        trace = record(title, reference, script)
+        assert len(trace.turns) == len(script)
+        trace = Trace.loads(trace.dumps())
+        replayed = replay(trace, game.dialogs)
+        assert replayed.game_state == reference.game_state
+        # a session that went elsewhere, and an option that is gone
+        middle = trace.turns[len(trace.turns) // 2]
+        for turn, field_name, value in [(middle, "draws", middle.draws + 1), (trace.turns[0], "option", "gone")]:
+            kept = getattr(turn, field_name)
+            setattr(turn, field_name, value)
+            try:
+                replay(trace, game.dialogs)
+            except ReplayDiverged:
+                pass
+            else:
+                assert False
+            setattr(turn, field_name, kept)
+        # an option the session could see that the game now hides
+        first = game.dialogs[trace.dialog_stack[0]]
+        chosen = next(o for o in first.options if o.id == trace.turns[0].option)
+        hidden = dict(game.dialogs)
+        hidden[first.id] = Dialog(first.id, first.text, [o if o is not chosen else dialogs.Option(
+            o.id, o.text, o.actions, screept.parse_expression("0")) for o in first.options])
+        try:
+            replay(trace, hidden)
+        except ReplayDiverged:
+            pass
+        else:
+            assert False
+    print("OK")
+
+
+def benchmark(title: str = "customGame", turns: int = 20000, seed: int = 0, rounds: int = 5):
+    """Replay throughput, the engine's regression benchmark: a fixed random session played back without I/O"""
+    import random
+    game = dialogs.load_game(title, seed=seed)
+    script = dialogs.random_choices(game, random.Random(seed), turns)
+    trace = record(title, dialogs.load_game(title, seed=seed), script)
+    actions = trace.actions()
+    print(f"{title}: {len(trace.turns)} turns, {actions} actions, trace {len(trace.dumps())} bytes")
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        replay(trace, game.dialogs)
+        best = min(best, time.perf_counter() - start)
+    print(f"replay: {actions / best:.0f} actions/s, {len(trace.turns) / best:.0f} turns/s")
+
+
+def main(argv: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(description="Replay a recorded dialogs trace")
+    commands = parser.add_subparsers(dest="command", required=True)
+    replay_command = commands.add_parser("replay")
+    replay_command.add_argument("path")
+    replay_command.add_argument("--slowest", type=int, default=10)
+    args = parser.parse_args(argv)
+    trace = Trace.load(args.path)
+    game = dialogs.load_game(trace.title)
+    timings: list[int] = []
+    start = time.perf_counter()
+    replay(trace, game.dialogs, timings=timings)
+    elapsed = time.perf_counter() - start
+    print(f"{len(trace.turns)} turns, {len(timings)} actions replayed in {elapsed * 1000:.1f}ms")
+    for ns, n, action in trace.slowest(args.slowest):
+        turn = trace.turns[n]
+        print(f"turn {n} {turn.dialog} option {turn.option}: {ns / 1000:.0f}us recorded, "
+              f"{timings[action] / 1000:.0f}us replayed")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main()
+    else:
+        test()
+        benchmark()
@@ -0,0 +1,312 @@
+"""
+Game server
+================
+
+Hosts many players in one asyncio process. Every game is loaded once and its
+dialogs, options and actions are shared by all sessions; a session only owns
+its Environment (vars, procedures, output and random stream) and its dialog
+stack.
+
+The protocol is JSON lines over TCP, one request and one response per line:
+
+    {"op": "new", "game": "customGame", "seed": 1}  -> {"session": "…", "view": {…}}
+    {"op": "render", "session": "…"}                -> {"view": {…}}
+    {"op": "choose", "session": "…", "choice": 1}   -> {"ok": true, "messages": […], "errors": […], "view": {…}}
+    {"op": "close", "session": "…"}                 -> {"ok": true}
+
+A view is {"dialog", "status_line", "text", "options"}, or {"dialog": null}
+once the dialog stack is empty. Errors come back as {"error": "…"}; the
+"errors" of a choice are its actions that failed, e.g. with OutOfFuel.
+
+Scripts run on the event loop, so each action is limited to `fuel` calls and
+every request to `timeout` seconds (see screept_compiler.limited): a player's
+script that loops fails instead of stalling everyone else. Sessions made on a
+connection are dropped when it closes.
+
+``python game_server.py serve`` runs a server, ``python game_server.py
+load-test`` drives simulated players against a local one.
+"""
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+import tracemalloc
+import uuid
+from dataclasses import asdict
+from typing import Optional
+
+import dialogs
+import screept
+import screept_compiler
+from dialogs import GameDefinition
+from dialogs_graph import DialogGraph
+
+
+class _SessionDriver(dialogs.GameDriver):
+    def __init__(self, game: GameDefinition, fuel: Optional[int], timeout: Optional[float], prewarm: int,
+                 graph: DialogGraph):
+        super().__init__(game, [], headless=True, fuel=fuel, timeout=timeout, prewarm=prewarm, graph=graph)
+        self.messages: list[str] = []
+        self.failures: list[str] = []
+
+    def show(self, text: str) -> None:
+        # DAMessage lines, sent back with the response to the choice
+        self.messages.append(text)
+
+    def action_error(self, e: Exception) -> None:
+        self.failures.append(f"{type(e).__name__}: {e}")
+
+
+class GameServer:
+    def __init__(self, titles: list[str], output_size: int = 100, prewarm: int = 3, max_depth: int = 256,
+                 max_cycle: int = 4, fuel: Optional[int] = dialogs.ACTION_FUEL, timeout: Optional[float] = 1.0):
+        self.games: dict[str, GameDefinition] = {title: dialogs.load_game(title) for title in titles}
+        # the compiled dialogs are shared too: warming them up around the start, and around where each player
+        # goes next, spares players the compiles
+        self.prewarm = prewarm
+        self.graphs = {title: DialogGraph(game.dialogs) for title, game in self.games.items()}
+        if prewarm:
+            for title, game in self.games.items():
+                self.graphs[title].prewarm(game.game_state.dialog_stack[:1], prewarm)
+        self.output_size = output_size
+        # sessions go on for as long as players stay, their stacks are bounded and compacted, see DialogStack
+        self.max_depth = max_depth
+        self.max_cycle = max_cycle
+        self.fuel = fuel
+        self.timeout = timeout
+        self.sessions: dict[str, _SessionDriver] = {}
+
+    def new_session(self, title: str, seed: Optional[int] = None) -> str:
+        game = dialogs.fork_game(self.games[title], screept.RingBufferSink(self.output_size), seed, self.max_depth,
+                                 self.max_cycle)
+        session = uuid.uuid4().hex
+        self.sessions[session] = _SessionDriver(game, self.fuel, self.timeout, self.prewarm, self.graphs[title])
+        return session
+
+    def view(self, session: str) -> dict:
+        driver = self.sessions[session]
+        state = driver.game.game_state
+        if not state.dialog_stack:
+            return {"dialog": None}
+        dialog_id = state.dialog_stack[0]
+        with screept_compiler.limited(self.fuel, self.timeout):
+            rendered = dialogs.render_dialog(driver.game.dialogs, dialog_id, state.environment)
+        return {"dialog": dialog_id} | asdict(rendered)
+
+    def choose(self, session: str, choice: int | str) -> dict:
+        driver = self.sessions[session]
+        if not driver.game.game_state.dialog_stack:
+            return {"ok": False, "messages": [], "errors": [], "view": {"dialog": None}}
+        driver.messages = []
+        driver.failures = []
+        # each action has its own fuel within the request's time
+        with screept_compiler.limited(timeout=self.timeout):
+            ok = driver.step(choice)
+        return {"ok": ok, "messages": driver.messages, "errors": driver.failures, "view": self.view(session)}
+
+    def handle(self, request: dict, owned: Optional[set[str]] = None) -> dict:
+        """The response to a request. Sessions it makes are added to `owned` and the ones it closes taken out."""
+        match request:
+            case {"op": "new", "game": title} if not isinstance(title, str) or title not in self.games:
+                return {"error": "Unknown game: " + repr(title)}
+            case {"op": "render" | "choose" | "close", "session": session} if (not isinstance(session, str) or
+                                                                               session not in self.sessions):
+                return {"error": "Unknown session: " + repr(session)}
+        # anything raised past here comes from running the game's scripts
+        try:
+            match request:
+                case {"op": "new", "game": title}:
+                    session = self.new_session(title, request.get("seed"))
+                    if owned is not None:
+                        owned.add(session)
+                    return {"session": session, "view": self.view(session)}
+                case {"op": "render", "session": session}:
+                    return {"view": self.view(session)}
+                case {"op": "choose", "session": session, "choice": choice}:
+                    return self.choose(session, choice)
+                case {"op": "close", "session": session}:
+                    del self.sessions[session]
+                    if owned is not None:
+                        owned.discard(session)
+                    return {"ok": True}
+                case _:
+                    return {"error": "Unknown request: " + repr(request)}
+        except Exception as e:
+            return {"error": f"{type(e).__name__}: {e}"}
+
+    async def _connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        # the sessions made on this connection, a player that drops off doesn't leave them behind
+        owned: set[str] = set()
+        try:
+            while line := await reader.readline():
+                try:
+                    response = self.handle(json.loads(line), owned)
+                except json.JSONDecodeError as e:
+                    response = {"error": "Bad JSON: " + str(e)}
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            for session in owned:
+                self.sessions.pop(session, None)
+            writer.close()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8765) -> asyncio.Server:
+        # the default 64 kB line limit is plenty for requests
+        return await asyncio.start_server(self._connection, host, port, backlog=4096)
+
+
+#
+
+
+async def _player(host: str, port: int, title: str, turns: int, seed: int, latencies: list[float]) -> int:
+    rng = random.Random(seed)
+    reader, writer = await asyncio.open_connection(host, port)
+
+    async def request(message: dict) -> dict:
+        start = time.perf_counter()
+        writer.write(json.dumps(message).encode() + b"\n")
+        await writer.drain()
+        response = json.loads(await reader.readline())
+        latencies.append(time.perf_counter() - start)
+        if "error" in response:
+            raise Exception(response["error"])
+        return response
+
+    response = await request({"op": "new", "game": title, "seed": seed})
+    session, view = response["session"], response["view"]
+    played = 0
+    for _ in range(turns):
+        if not view.get("options"):
+            break
+        view = (await request({"op": "choose", "session": session,
+                               "choice": rng.randrange(len(view["options"])) + 1}))["view"]
+        played += 1
+    await request({"op": "close", "session": session})
+    writer.close()
+    return played
+
+
+def session_memory(server: GameServer, title: str, count: int = 1000) -> float:
+    """Bytes held per session, after each rendered its first dialog"""
+    tracemalloc.start()
+    sessions = [server.new_session(title, n) for n in range(count)]
+    for session in sessions:
+        server.view(session)
+    held, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    for session in sessions:
+        del server.sessions[session]
+    return held / count
+
+
+async def load_test(title: str = "customGame", players: int = 2000, turns: int = 20, host: str = "127.0.0.1",
+                    port: int = 0) -> None:
+    """Simulated players, each on its own connection, against a server in this process"""
+    server = GameServer([title])
+    tcp = await server.start(host, port)
+    port = tcp.sockets[0].getsockname()[1]
+    latencies: list[float] = []
+    start = time.perf_counter()
+    played = await asyncio.gather(*(_player(host, port, title, turns, n, latencies) for n in range(players)))
+    elapsed = time.perf_counter() - start
+    tcp.close()
+    await tcp.wait_closed()
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(f"{players} players, {sum(played)} turns, {len(latencies)} requests in {elapsed:.2f}s "
+          f"({len(latencies) / elapsed:.0f} requests/s)")
+    print(f"latency p50 {quantiles[49] * 1000:.2f}ms, p99 {quantiles[98] * 1000:.2f}ms")
+    print(f"{session_memory(server, title):.0f} bytes per session")
+
+
+def test():
+    server = GameServer(["customGame"])
+    new = server.handle({"op": "new", "game": "customGame", "seed": 1})
+    other = server.handle({"op": "new", "game": "customGame", "seed": 1})
+    session = new["session"]
+    assert new["view"]["options"]
+    chosen = server.handle({"op": "choose", "session": session, "choice": 1})
+    assert chosen["ok"]
+    assert not server.handle({"op": "choose", "session": session, "choice": 99})["ok"]
+    # the dialogs around where a player went are compiled by the time they get there
+    graph = server.graphs["customGame"]
+    here = server.sessions[session].game.game_state.dialog_stack[0]
+    assert set(graph.within([here], server.prewarm)) <= graph._warm
+    # sessions share the dialogs, not the state
+    state, other_state = (server.sessions[s].game.game_state for s in [session, other["session"]])
+    assert server.sessions[session].game.dialogs is server.sessions[other["session"]].game.dialogs
+    assert state.environment.vars != other_state.environment.vars
+    assert server.handle({"op": "render", "session": other["session"]}) == {"view": other["view"]}
+    assert server.handle({"op": "render", "session": "nope"}) == {"error": "Unknown session: 'nope'"}
+    assert server.handle({"op": "new", "game": "nope"}) == {"error": "Unknown game: 'nope'"}
+    assert server.handle({"op": "close", "session": session}) == {"ok": True}
+
+    # scripts that never end fail with OutOfFuel, and errors from scripts are reported as they are
+    server = GameServer(["customGame"], fuel=100)
+    text = screept.ValueString("")
+    forever = screept.parse_statement("{ PROC loop { RUN loop() }; RUN loop() }")
+    missing = screept.parse_statement("x = missing")
+    server.games["loop"] = GameDefinition(
+        dialogs.GameState(screept.Environment(screept.SlotVars(), {}, []), dialogs.DialogStack(["a"])),
+        {"a": dialogs.Dialog("a", text, [dialogs.Option("1", text, [dialogs.DAScreept(forever)]),
+                                         dialogs.Option("2", text, [dialogs.DAScreept(missing)])])}, 0)
+    server.graphs["loop"] = DialogGraph(server.games["loop"].dialogs)
+    session = server.handle({"op": "new", "game": "loop"})["session"]
+    chosen = server.handle({"op": "choose", "session": session, "choice": 1})
+    assert chosen["ok"] and chosen["errors"] == ["OutOfFuel: ran out of fuel after 100 calls"]
+    assert server.handle({"op": "choose", "session": session, "choice": 2})["errors"] == ["KeyError: 'missing'"]
+    env = server.sessions[session].game.game_state.environment
+    env.vars["__statusLine"] = screept.ValueFunction(screept.parse_expression('$["__statusLine"]()'))
+    assert server.handle({"op": "render", "session": session})["error"].startswith("OutOfFuel")
+
+    # a player that drops off without closing its sessions
+    async def drop_off() -> None:
+        tcp = await server.start(port=0)
+        reader, writer = await asyncio.open_connection(*tcp.sockets[0].getsockname()[:2])
+        for _ in range(3):
+            writer.write(json.dumps({"op": "new", "game": "customGame"}).encode() + b"\n")
+            await reader.readline()
+        assert len(server.sessions) == 4
+        writer.close()
+        await writer.wait_closed()
+        for _ in range(100):
+            if len(server.sessions) == 1:
+                break
+            await asyncio.sleep(0.01)
+        tcp.close()
+        await tcp.wait_closed()
+
+    asyncio.run(drop_off())
+    assert list(server.sessions) == [session]
+    print("OK")
+
+
+def main(argv: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve = commands.add_parser("serve")
+    serve.add_argument("titles", nargs="*", default=["customGame", "fable"])
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8765)
+    load = commands.add_parser("load-test")
+    load.add_argument("--game", default="customGame")
+    load.add_argument("--players", type=int, default=2000)
+    load.add_argument("--turns", type=int, default=20)
+    args = parser.parse_args(argv)
+    match args.command:
+        case "serve":
+            async def serve_forever():
+                tcp = await GameServer(args.titles).start(args.host, args.port)
+                print("Serving on", ", ".join(str(s.getsockname()) for s in tcp.sockets))
+                await tcp.serve_forever()
+
+            asyncio.run(serve_forever())
+        case "load-test":
+            asyncio.run(load_test(args.game, args.players, args.turns))
+
+
+if __name__ == '__main__':
+    main()
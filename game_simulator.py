@@ -0,0 +1,257 @@
+"""
+Monte-Carlo playthroughs
+================
+
+Plays a game headless many times over with a policy picking among the
+visible options, to see how often each ending comes up and how vars like
+``money`` and ``stamina`` are spread at the end. Playthrough n runs with RND
+seeded from n, so a run is reproducible and any playthrough can be looked at
+again on its own.
+
+Every action, and every check of which options are visible, runs with
+``fuel`` (see ``screept_compiler.limited``), so a script that loops fails with
+OutOfFuel instead of hanging a worker. Failed actions are counted by exception
+type in ``Stats.errors``.
+
+Playthroughs are split into chunks over a ``ProcessPoolExecutor``. Workers
+get the game from the parent when processes are forked, otherwise they load
+it from its bundle (see ``dialogs_bundle``); either way nothing is parsed per
+playthrough. Only the aggregated ``Stats`` of each chunk go back, merged as
+chunks complete and handed to ``progress`` along the way.
+
+``python game_simulator.py customGame -n 1000000`` runs a simulation.
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import time
+from collections import Counter
+from collections.abc import Callable, Sequence
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from typing import Optional
+
+import dialogs
+import screept
+import screept_compiler
+from dialogs import Dialog, GameDefinition, Option
+
+Policy = Callable[[Dialog, Sequence[Option], random.Random], Option]
+
+
+def random_policy(dialog: Dialog, options: Sequence[Option], rng: random.Random) -> Option:
+    return options[rng.randrange(len(options))]
+
+
+@dataclass
+class ScriptedPolicy:
+    """Per dialog, the option ids to pick in order of preference; a random visible option when none of them is"""
+    preferences: dict[str, list[str]]
+
+    def __call__(self, dialog: Dialog, options: Sequence[Option], rng: random.Random) -> Option:
+        for option_id in self.preferences.get(dialog.id, ()):
+            for option in options:
+                if option.id == option_id:
+                    return option
+        return options[rng.randrange(len(options))]
+
+
+@dataclass
+class Stats:
+    playthroughs: int = 0
+    # "(stack empty)" after going back from the first dialog, "<dialog> (no options)" at a dead end,
+    # "<dialog> (options failed)" when its conditions raised, "<dialog> (turn limit)" when it still went on
+    endings: Counter = field(default_factory=Counter)
+    # turns played, in buckets of turn_bucket
+    turns: Counter = field(default_factory=Counter)
+    # var -> value at the end, in buckets of bucket; vars missing or not numbers are left out
+    vars: dict[str, Counter] = field(default_factory=dict)
+    # exception type name -> actions that raised it
+    errors: Counter = field(default_factory=Counter)
+
+    def merge(self, other: "Stats") -> None:
+        self.playthroughs += other.playthroughs
+        self.endings.update(other.endings)
+        self.turns.update(other.turns)
+        for name, histogram in other.vars.items():
+            self.vars.setdefault(name, Counter()).update(histogram)
+        self.errors.update(other.errors)
+
+    def report(self, top: int = 10) -> str:
+        errors = "".join(f", {name} {count}" for name, count in self.errors.most_common())
+        lines = [f"{self.playthroughs} playthroughs, {self.errors.total()} action errors{errors}", "endings:"]
+        lines += [f"  {count / self.playthroughs:7.2%} {ending}" for ending, count in self.endings.most_common(top)]
+        for name, histogram in [("turns", self.turns)] + sorted(self.vars.items()):
+            lines.append(name + ":")
+            lines += [f"  {bucket:>10g} {count / self.playthroughs:7.2%}"
+                      for bucket, count in sorted(histogram.items())]
+        return "\n".join(lines)
+
+
+def play(game: GameDefinition, policy: Policy, rng: random.Random, max_turns: int,
+         fuel: Optional[int] = dialogs.ACTION_FUEL) -> tuple[str, int, Counter]:
+    """Plays until the dialog stack runs out, a dialog has no visible options or max_turns, returns the ending,
+    the turns played and the action errors by exception type. A dialog whose options can't be worked out ends
+    the playthrough, with its error counted too."""
+    state = game.game_state
+    stack = state.dialog_stack
+    env = state.environment
+    errors = Counter()
+    for turn in range(max_turns):
+        if not stack:
+            return "(stack empty)", turn, errors
+        dialog = game.dialogs[stack[0]]
+        try:
+            with screept_compiler.limited(fuel):
+                options = dialogs.get_dialog_visible_options(dialog, env)
+        except Exception as e:
+            errors[type(e).__name__] += 1
+            return dialog.id + " (options failed)", turn, errors
+        if not options:
+            return dialog.id + " (no options)", turn, errors
+        for action in policy(dialog, options, rng).actions:
+            try:
+                with screept_compiler.limited(fuel):
+                    dialogs.execute_action(game, action, _ignore)
+            except Exception as e:
+                errors[type(e).__name__] += 1
+    if not stack:
+        return "(stack empty)", max_turns, errors
+    return stack[0] + " (turn limit)", max_turns, errors
+
+
+def _ignore(text: str) -> None:
+    pass
+
+
+def _bucket(x: float, size: float) -> float:
+    return x // size * size
+
+
+# the game of this process, set in the parent before forking or loaded by _init_worker
+_game: Optional[GameDefinition] = None
+_title: Optional[str] = None
+
+
+def _init_worker(title: str) -> None:
+    global _game, _title
+    if _title != title:
+        _game, _title = dialogs.load_game(title, output_size=0), title
+
+
+def play_chunk(title: str, first: int, count: int, policy: Policy, max_turns: int, track: Sequence[str],
+               bucket: float, turn_bucket: int, fuel: Optional[int] = dialogs.ACTION_FUEL) -> Stats:
+    """Playthroughs first .. first + count - 1"""
+    _init_worker(title)
+    stats = Stats(vars={name: Counter() for name in track})
+    for n in range(first, first + count):
+        game = dialogs.fork_game(_game, screept.NullSink(), n)
+        ending, turns, errors = play(game, policy, random.Random(n), max_turns, fuel)
+        stats.endings[ending] += 1
+        stats.turns[_bucket(turns, turn_bucket)] += 1
+        stats.errors.update(errors)
+        env_vars = game.game_state.environment.vars
+        for name in track:
+            value = env_vars.get(name)
+            if isinstance(value, screept.ValueNumber):
+                stats.vars[name][_bucket(value.value, bucket)] += 1
+    stats.playthroughs = count
+    return stats
+
+
+def simulate(title: str, playthroughs: int, policy: Policy = random_policy, max_turns: int = 200,
+             track: Sequence[str] = ("money", "stamina"), bucket: float = 10, turn_bucket: int = 20,
+             workers: Optional[int] = None, chunk_size: int = 2000,
+             progress: Optional[Callable[[Stats], None]] = None, fuel: Optional[int] = dialogs.ACTION_FUEL) -> Stats:
+    workers = workers or os.cpu_count() or 1
+    chunks = [(first, min(chunk_size, playthroughs - first)) for first in range(0, playthroughs, chunk_size)]
+    stats = Stats(vars={name: Counter() for name in track})
+    if workers == 1:
+        for first, count in chunks:
+            stats.merge(play_chunk(title, first, count, policy, max_turns, track, bucket, turn_bucket, fuel))
+            if progress is not None:
+                progress(stats)
+        return stats
+    context = None
+    if "fork" in multiprocessing.get_all_start_methods():
+        # children start with the game already loaded and warmed, its pages shared until written to
+        context = multiprocessing.get_context("fork")
+        _init_worker(title)
+        import dialogs_graph
+        dialogs_graph.prewarm(_game, len(_game.dialogs))
+    with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker, initargs=(title,)) as pool:
+        futures = [pool.submit(play_chunk, title, first, count, policy, max_turns, track, bucket, turn_bucket, fuel)
+                   for first, count in chunks]
+        for future in as_completed(futures):
+            stats.merge(future.result())
+            if progress is not None:
+                progress(stats)
+    return stats
+
+
+#
+
+
+def test():
+    serial = simulate("customGame", 300, workers=1, chunk_size=100)
+    assert serial.playthroughs == 300 and sum(serial.endings.values()) == 300
+    assert sum(serial.vars["money"].values()) == 300
+    # the same seeds give the same playthroughs, however they are split among processes
+    parallel = simulate("customGame", 300, workers=2, chunk_size=70)
+    assert parallel == serial
+    game = dialogs.load_game("customGame")
+    start = game.dialogs[game.game_state.dialog_stack[0]]
+    # always the last option of the first dialog, where the random policy takes either
+    scripted = simulate("customGame", 300, ScriptedPolicy({start.id: [start.options[-1].id]}), workers=1)
+    assert scripted.playthroughs == 300 and scripted != serial
+    # a script that never ends fails every time instead of hanging the worker
+    text = screept.ValueString("")
+    forever = screept.parse_statement("{ PROC loop { RUN loop() }; RUN loop() }")
+    looping = GameDefinition(dialogs.GameState(screept.Environment(screept.SlotVars(), {}, []),
+                                               dialogs.DialogStack(["a"])),
+                             {"a": Dialog("a", text, [Option("1", text, [dialogs.DAScreept(forever)])])}, 0)
+    assert play(looping, random_policy, random.Random(0), 3, fuel=100) == ("a (turn limit)", 3,
+                                                                             Counter({"OutOfFuel": 3}))
+    print("OK")
+
+
+def benchmark(title: str = "customGame", playthroughs: int = 20000, max_turns: int = 100):
+    """Playthroughs per second by number of worker processes"""
+    cores = os.cpu_count() or 1
+    counts = sorted({1, 2, cores // 2 or 1, cores})
+    base = None
+    for workers in counts:
+        start = time.perf_counter()
+        simulate(title, playthroughs, max_turns=max_turns, workers=workers)
+        elapsed = time.perf_counter() - start
+        base = base or playthroughs / elapsed
+        print(f"{workers:3} workers: {playthroughs / elapsed:8.0f} playthroughs/s, "
+              f"{playthroughs / elapsed / base:.2f}x ({cores} cores)")
+
+
+def main(argv: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(description="Monte-Carlo playthroughs of a game with random options")
+    parser.add_argument("title")
+    parser.add_argument("-n", "--playthroughs", type=int, default=100000)
+    parser.add_argument("--max-turns", type=int, default=200)
+    parser.add_argument("--track", nargs="*", default=["money", "stamina"])
+    parser.add_argument("--bucket", type=float, default=10)
+    parser.add_argument("--workers", type=int)
+    args = parser.parse_args(argv)
+    last = [time.perf_counter()]
+
+    def progress(stats: Stats) -> None:
+        if time.perf_counter() - last[0] > 5:
+            last[0] = time.perf_counter()
+            print(f"{stats.playthroughs} / {args.playthroughs}", flush=True)
+
+    start = time.perf_counter()
+    stats = simulate(args.title, args.playthroughs, max_turns=args.max_turns, track=args.track, bucket=args.bucket,
+                     workers=args.workers, progress=progress)
+    print(stats.report())
+    print(f"{time.perf_counter() - start:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,34 +1,198 @@
+"""
+Kafka producer
+================
+
+Produces message_gen messages ({"to", "from", "content"}, keyed by "to") to
+the docker-compose broker. librdkafka batches them per partition; the knobs
+that matter for throughput are linger.ms, batch.size and compression.type.
+Delivery reports only update ``DeliveryStats``, which is printed every few
+seconds. When the local queue is full, produce() raises BufferError, and we
+serve delivery reports until there is room again instead of dropping the
+message. SIGINT and SIGTERM stop the loop, then everything still queued is
+flushed.
+
+    python kafka_producer.py --rate 1000
+    python kafka_producer.py --count 1000000 benchmark
+"""
+import argparse
 import json
-from time import sleep
+import signal
+import time
+from collections import Counter
+from collections.abc import Iterable, Iterator
+from itertools import cycle, islice
+from typing import Optional
 
-from confluent_kafka import Producer
+from confluent_kafka import Producer, KafkaError, Message
 
-p = Producer({'bootstrap.servers': 'localhost:29092'})
 import message_gen
 
-def delivery_report(err, msg):
-    """ Called once for each message produced to indicate delivery result.
-        Triggered by poll() or flush(). """
-    if err is not None:
-        print('Message delivery failed: {}'.format(err))
-    else:
-        print('Message delivered to {} [{}]'.format(msg.topic(), msg.partition()))
-
-
-
-while True:
-    # Trigger any available delivery report callbacks from previous produce() calls
-    p.poll(0)
-    sender=message_gen.generate_name()
-    to=message_gen.generate_name()
-    content = message_gen.get_polite_message()
-    msg={"to": to,"from":sender,"content":content}
-    # Asynchronously produce a message. The delivery report callback will
-    # be triggered from the call to poll() above, or flush() below, when the
-
-    # message has been successfully delivered or failed permanently.
-    p.produce(topic='trzeci',value= json.dumps(msg).encode('utf-8'),key=to.encode('utf-8'), callback=delivery_report)
-    sleep(2)
-# Wait for any outstanding messages to be delivered and delivery report
-# callbacks to be triggered.
-p.flush()
+BOOTSTRAP_SERVERS = 'localhost:29092'
+TOPIC = 'trzeci'
+
+# without a rate, delivery reports are served once per this many messages
+POLL_EVERY = 1000
+
+
+class DeliveryStats:
+    def __init__(self):
+        self.produced = 0
+        self.delivered = 0
+        self.failed = 0
+        self.delivered_bytes = 0
+        self.errors: Counter[str] = Counter()
+        # times produce() found the local queue full
+        self.full = 0
+
+    def delivery_report(self, err: Optional[KafkaError], msg: Message) -> None:
+        """Called from poll() and flush() once per message, with err set if it failed for good"""
+        if err is not None:
+            self.failed += 1
+            self.errors[err.name()] += 1
+        else:
+            self.delivered += 1
+            self.delivered_bytes += len(msg)
+
+    def pending(self) -> int:
+        return self.produced - self.delivered - self.failed
+
+    def __str__(self) -> str:
+        errors = "".join(f", {name} {count}" for name, count in self.errors.most_common())
+        return (f"produced {self.produced}, delivered {self.delivered} ({self.delivered_bytes / 1e6:.1f} MB), "
+                f"failed {self.failed}{errors}, pending {self.pending()}, queue full {self.full} times")
+
+
+def producer_config(linger_ms: int = 20, batch_size: int = 1_000_000, compression: str = 'lz4',
+                    acks: str = 'all', bootstrap_servers: str = BOOTSTRAP_SERVERS) -> dict:
+    return {
+        'bootstrap.servers': bootstrap_servers,
+        'linger.ms': linger_ms,
+        'batch.size': batch_size,
+        'compression.type': compression,
+        'acks': acks,
+        # retries can't reorder or duplicate messages
+        'enable.idempotence': acks == 'all',
+        'queue.buffering.max.messages': 500_000,
+        'queue.buffering.max.kbytes': 1_048_576,
+    }
+
+
+def messages() -> Iterator[tuple[bytes, bytes]]:
+    """(key, value) pairs of random messages, for ever"""
+    while True:
+        sender = message_gen.generate_name()
+        to = message_gen.generate_name()
+        msg = {"to": to, "from": sender, "content": message_gen.get_polite_message()}
+        yield to.encode('utf-8'), json.dumps(msg).encode('utf-8')
+
+
+class StopSignal:
+    """Set by SIGINT or SIGTERM while installed, the handlers before are put back on exit"""
+
+    def __init__(self):
+        self.stopped = False
+        self._previous = {}
+
+    def _handle(self, signum, frame) -> None:
+        self.stopped = True
+
+    def __enter__(self) -> "StopSignal":
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            self._previous[signum] = signal.signal(signum, self._handle)
+        return self
+
+    def __exit__(self, *exc) -> None:
+        for signum, handler in self._previous.items():
+            signal.signal(signum, handler)
+
+
+def produce(producer: Producer, payloads: Iterable[tuple[bytes, bytes]], stats: DeliveryStats, topic: str = TOPIC,
+            rate: float = 0, stop: Optional[StopSignal] = None, report_every: float = 5.0,
+            flush_timeout: float = 30.0) -> DeliveryStats:
+    """Produces the payloads at up to `rate` messages/s (0 for as fast as possible) until they run out or `stop` is
+    set, then flushes. Returns stats."""
+    stop = stop or StopSignal()
+    start = last_report = time.monotonic()
+    delivery_report = stats.delivery_report
+    for key, value in payloads:
+        while not stop.stopped:
+            try:
+                producer.produce(topic, value, key, on_delivery=delivery_report)
+                break
+            except BufferError:
+                # the local queue is full: wait for deliveries to make room
+                stats.full += 1
+                producer.poll(0.1)
+        else:
+            break
+        stats.produced += 1
+        if rate:
+            # waiting for the next message's turn serves delivery reports
+            while (ahead := start + stats.produced / rate - time.monotonic()) > 0 and not stop.stopped:
+                producer.poll(min(ahead, 0.5))
+        elif stats.produced % POLL_EVERY:
+            continue
+        producer.poll(0)
+        now = time.monotonic()
+        if now - last_report >= report_every:
+            last_report = now
+            print(stats, flush=True)
+        if stop.stopped:
+            break
+    remaining = producer.flush(flush_timeout)
+    if remaining:
+        print(f"{remaining} messages still undelivered after {flush_timeout}s")
+    return stats
+
+
+#
+
+
+def benchmark(count: int = 1_000_000, topic: str = TOPIC, bootstrap_servers: str = BOOTSTRAP_SERVERS):
+    """Messages/s and MB/s against the docker-compose broker, unbatched and with a few batching settings. The
+    payloads are generated up front so message_gen isn't what gets measured."""
+    payloads = list(islice(messages(), 10_000))
+    size = sum(len(key) + len(value) for key, value in payloads) / len(payloads)
+    print(f"{count} messages of {size:.0f} bytes on average")
+    for linger_ms, batch_size, compression in [(0, 16_384, 'none'), (5, 100_000, 'none'), (20, 1_000_000, 'none'),
+                                               (20, 1_000_000, 'lz4'), (50, 1_000_000, 'zstd')]:
+        producer = Producer(producer_config(linger_ms, batch_size, compression, bootstrap_servers=bootstrap_servers))
+        stats = DeliveryStats()
+        started = time.perf_counter()
+        with StopSignal() as stop:
+            produce(producer, islice(cycle(payloads), count), stats, topic, stop=stop, report_every=float('inf'))
+        elapsed = time.perf_counter() - started
+        print(f"linger.ms={linger_ms:<3} batch.size={batch_size:<8} {compression:>5}: "
+              f"{stats.delivered / elapsed:9.0f} msgs/s {stats.delivered * size / elapsed / 1e6:7.1f} MB/s, "
+              f"{stats.failed} failed")
+        if stop.stopped:
+            break
+
+
+def main(argv: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(description="Produce message_gen messages to Kafka")
+    parser.add_argument("--bootstrap-servers", default=BOOTSTRAP_SERVERS)
+    parser.add_argument("--topic", default=TOPIC)
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("benchmark")
+    parser.add_argument("--rate", type=float, default=0, help="messages per second, 0 for as fast as possible")
+    parser.add_argument("--count", type=int,
+                        help="stop after this many messages; messages per setting for benchmark, 1000000 by default")
+    parser.add_argument("--linger-ms", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=1_000_000)
+    parser.add_argument("--compression", default='lz4', choices=['none', 'gzip', 'snappy', 'lz4', 'zstd'])
+    parser.add_argument("--acks", default='all', choices=['0', '1', 'all'])
+    args = parser.parse_args(argv)
+    if args.command == "benchmark":
+        benchmark(1_000_000 if args.count is None else args.count, args.topic, args.bootstrap_servers)
+        return
+    producer = Producer(producer_config(args.linger_ms, args.batch_size, args.compression, args.acks,
+                                        args.bootstrap_servers))
+    stats = DeliveryStats()
+    with StopSignal() as stop:
+        produce(producer, islice(messages(), args.count), stats, args.topic, args.rate, stop)
+    print(stats)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,26 +4,37 @@ Screept
 
 Implements Screept "programming language" in python >3.12
 """
+import asyncio
+import gc
+import os
 import random
-from collections.abc import MutableMapping, Callable
+import time
+import tracemalloc
+from collections import deque
+from collections.abc import MutableMapping, Mapping, Callable, Iterator
 from copy import deepcopy
-from math import floor
+from math import floor, copysign
 from pprint import pprint
-from typing import Sequence, override, Optional
+from typing import Sequence, override, Optional, TextIO
 from abc import ABC, abstractmethod
 from lark import Lark, Transformer, v_args, Token, tree
-from dataclasses import dataclass
+from dataclasses import dataclass, field, fields, is_dataclass
+from functools import cache, lru_cache
+from itertools import count
 
 
 class Expression:
-    pass
+    __slots__ = ()
 
 
 class ExprLiteralValue(Expression):
-    pass
+    __slots__ = ()
 
 
 class Value(ExprLiteralValue, ABC):
+    """Values are immutable, so literal nodes evaluate to themselves and instances can be shared freely"""
+    __slots__ = ()
+
     @abstractmethod
     def get_string(self) -> str:
         pass
@@ -52,7 +63,7 @@ class ExpressionVar(Expression):
     identifier: Identifier
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class ValueNumber(Value):
     value: float
 
@@ -65,7 +76,7 @@ class ValueNumber(Value):
         return self.value
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class ValueString(Value):
     value: str
 
@@ -78,7 +89,7 @@ class ValueString(Value):
         return 1
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class ValueFunction(Value):
     value: Expression
 
@@ -91,6 +102,27 @@ class ValueFunction(Value):
         return 1
 
 
+# ints and integral floats print differently ("1" and "1.0"), so each gets its own cache
+_SMALL_MIN = -128
+_SMALL_MAX = 1024
+_small_ints = [ValueNumber(n) for n in range(_SMALL_MIN, _SMALL_MAX)]
+_small_floats = [ValueNumber(float(n)) for n in range(_SMALL_MIN, _SMALL_MAX)]
+
+TRUE = _small_ints[1 - _SMALL_MIN]
+FALSE = ZERO = _small_ints[-_SMALL_MIN]
+
+
+def number(n: float) -> ValueNumber:
+    """ValueNumber(n), shared for small integral values"""
+    if n.__class__ is int:
+        if _SMALL_MIN <= n < _SMALL_MAX:
+            return _small_ints[n - _SMALL_MIN]
+    elif n.__class__ is float and n.is_integer() and _SMALL_MIN <= n < _SMALL_MAX and (n or copysign(1.0, n) > 0):
+        # -0.0 is left out, it prints as "-0.0"
+        return _small_floats[int(n) - _SMALL_MIN]
+    return ValueNumber(n)
+
+
 @dataclass
 class ExprFuncCall(Expression):
     identifier: Identifier
@@ -190,11 +222,361 @@ class Statement:
     pass
 
 
+class OutOfFuel(Exception):
+    """A run went past its fuel, see screept_compiler.limited and screept_iterative.Execution"""
+    pass
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class OutputSink(ABC):
+    """Where PRINT lines go. Anything with `append(line)` works as Environment.output, a plain list included;
+    a sink can also be given as the emit_handler, so EMIT can go to the same places."""
+
+    @abstractmethod
+    def append(self, line: str) -> None:
+        pass
+
+    def __call__(self, line: str) -> None:
+        self.append(line)
+
+
+class NullSink(OutputSink):
+    def append(self, line: str) -> None:
+        pass
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, NullSink)
+
+
+class RingBufferSink(OutputSink):
+    """Keeps the last `size` lines, so memory stays flat however much gets printed"""
+
+    def __init__(self, size: int = 1000, lines: Sequence[str] = (), total: int = 0):
+        self.size = size
+        self.lines: deque[str] = deque(lines, maxlen=size)
+        self.total = max(total, len(self.lines))
+
+    def append(self, line: str) -> None:
+        self.lines.append(line)
+        self.total += 1
+
+    @property
+    def dropped(self) -> int:
+        return self.total - len(self.lines)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.lines)
+
+    def __len__(self) -> int:
+        return len(self.lines)
+
+    def __getitem__(self, index: int) -> str:
+        return self.lines[index]
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, RingBufferSink) and (self.size, self.total, self.lines) == \
+            (other.size, other.total, other.lines)
+
+    def __reduce__(self):
+        # a deque would have to come from collections, which snapshots don't load
+        return RingBufferSink, (self.size, list(self.lines), self.total)
+
+    def __repr__(self) -> str:
+        return f"RingBufferSink({self.size}, {list(self.lines)!r}, {self.total})"
+
+
+class QueueSink(OutputSink):
+    """Puts lines on an asyncio.Queue for a consumer task. With a bounded queue the oldest line is dropped
+    to make room, the interpreter never waits. Give the loop when appending from another thread."""
+
+    def __init__(self, queue: asyncio.Queue, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.queue = queue
+        self.loop = loop
+        self.dropped = 0
+
+    def _put(self, line: str) -> None:
+        queue = self.queue
+        if queue.full():
+            queue.get_nowait()
+            self.dropped += 1
+        queue.put_nowait(line)
+
+    def append(self, line: str) -> None:
+        if self.loop is None:
+            self._put(line)
+        else:
+            self.loop.call_soon_threadsafe(self._put, line)
+
+
+class StreamSink(OutputSink):
+    """Writes a line at a time to a text stream, e.g. sys.stdout"""
+
+    def __init__(self, stream: TextIO, flush: bool = False):
+        self.stream = stream
+        self.flush = flush
+
+    def append(self, line: str) -> None:
+        self.stream.write(line + "\n")
+        if self.flush:
+            self.stream.flush()
+
+
+class FileSink(StreamSink):
+    def __init__(self, path: str, flush: bool = False):
+        super().__init__(open(path, "a", encoding="utf-8"), flush)
+
+    def close(self) -> None:
+        self.stream.close()
+
+    def __enter__(self) -> "FileSink":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+
+class TeeSink(OutputSink):
+    def __init__(self, *sinks: OutputSink):
+        self.sinks = sinks
+
+    def append(self, line: str) -> None:
+        for sink in self.sinks:
+            sink.append(line)
+
+
+class Rng:
+    """The random stream RND draws from. Each Environment has its own, so sessions don't share one and a run can
+    be replayed from its seed. Every draw takes one 64-bit number: with NumPy they come `block_size` at a time from
+    PCG64, without it one by one from random.Random, which gives another stream for the same seed."""
+    __slots__ = ('seed', 'block_size', '_base', '_block', '_next', '_source')
+
+    def __init__(self, seed: Optional[int] = None, block_size: int = 256, drawn: int = 0):
+        # the global random module picks the seed, so random.seed() makes new environments reproducible too
+        self.seed = random.getrandbits(64) if seed is None else seed
+        self.block_size = block_size
+        # draws before the current block
+        self._base = drawn
+        self._block: list[int] = []
+        self._next = 0
+        # made on the first draw, environments that never RND don't pay for it
+        self._source = None
+
+    @property
+    def drawn(self) -> int:
+        return self._base + self._next
+
+    def _refill(self) -> None:
+        source = self._source
+        if source is None:
+            try:
+                import numpy
+            except ImportError:
+                source = random.Random(self.seed)
+                for _ in range(self._base):
+                    source.getrandbits(64)
+            else:
+                source = numpy.random.PCG64(self.seed)
+                source.advance(self._base)
+            self._source = source
+        self._base += self._next
+        if isinstance(source, random.Random):
+            self._block = [source.getrandbits(64) for _ in range(self.block_size)]
+        else:
+            self._block = source.random_raw(self.block_size).tolist()
+        self._next = 0
+
+    def randint(self, a: int, b: int) -> int:
+        """Same contract as random.randint"""
+        if a > b:
+            raise ValueError(f"empty range in randint({a}, {b})")
+        i = self._next
+        block = self._block
+        if i == len(block):
+            self._refill()
+            i = 0
+            block = self._block
+        self._next = i + 1
+        return a + block[i] % (b - a + 1)
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, Rng) and (self.seed, self.drawn) == (other.seed, other.drawn)
+
+    def __reduce__(self):
+        # the stream is its seed and how far it got, copies pick up from there
+        return Rng, (self.seed, self.block_size, self.drawn)
+
+    def __repr__(self) -> str:
+        return f"Rng({self.seed}, drawn={self.drawn})"
+
+
 @dataclass
 class Environment:
     vars: MutableMapping[str, Value]
     procedures: MutableMapping[str, Statement]
-    output: list[str]
+    # a list keeps everything, see OutputSink for the alternatives
+    output: list[str] | OutputSink
+    rng: Rng = field(default_factory=Rng)
+
+
+class Scope(MutableMapping[str, Value]):
+    """Vars of a function call: a frame with the call's own `_0.._n` linked to the caller's vars.
+    Reads fall through to the parent, writes stay in the frame, so nothing leaks out of the call."""
+    __slots__ = ('frame', 'parent', 'slot_values')
+
+    def __init__(self, frame: dict[str, Value], parent: Mapping[str, Value]):
+        self.frame = frame
+        self.parent = parent
+        # Names with a slot are never in a frame, so they can be read straight from the parent's store
+        self.slot_values = getattr(parent, 'slot_values', None)
+
+    def __getitem__(self, key: str) -> Value:
+        frame = self.frame
+        if key in frame:
+            return frame[key]
+        return self.parent[key]
+
+    def __setitem__(self, key: str, value: Value) -> None:
+        self.frame[key] = value
+
+    def __delitem__(self, key: str) -> None:
+        # only the frame can be written to, same as collections.ChainMap
+        del self.frame[key]
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.frame or key in self.parent
+
+    def __iter__(self) -> Iterator[str]:
+        yield from self.frame
+        for key in self.parent:
+            if key not in self.frame:
+                yield key
+
+    def __len__(self) -> int:
+        return len(self.frame) + sum(1 for key in self.parent if key not in self.frame)
+
+    def __repr__(self) -> str:
+        return f"Scope({self.frame!r}, {self.parent!r})"
+
+
+def is_argument(name: str) -> bool:
+    return name.startswith('_') and name[1:].isdigit()
+
+
+class SlotTable:
+    """Gives every name used by a literal identifier a fixed index into SlotVars.slot_values.
+    Call arguments `_0.._n` get none: inside function bodies they live in Scope frames, not in the store."""
+
+    def __init__(self):
+        self.slots: dict[str, int] = {}
+        self.names: list[str] = []
+
+    def slot(self, name: str) -> Optional[int]:
+        slot = self.slots.get(name)
+        if slot is None and not is_argument(name):
+            slot = self.slots[name] = len(self.names)
+            self.names.append(name)
+        return slot
+
+
+# one table for the process, so a name resolves to the same slot in every program and environment
+slots = SlotTable()
+
+UNBOUND = object()
+
+# Every write to a slot gets the next number as its stamp. Stamps are unique in the process and copied along with
+# the values, so an equal stamp means the very same value, in whatever environment.
+_writes = count(1)
+
+
+class SlotVars(MutableMapping[str, Value]):
+    """Vars kept in a list indexed by `slots`. Names without a slot, the arguments and whatever a computed
+    identifier ($[...]) comes up with that no literal identifier uses, go to a dict. Only resolve_names and the
+    compilers give out slots, writing a name never does, so names made up at run time can't grow the table.
+    A name can get its slot after it went to the dict; it stays there until the slot is first written.
+    `stamps` has the stamp of the last write to each slot, 0 for never written."""
+    __slots__ = ('slot_values', 'stamps', 'extra')
+
+    def __init__(self, items: Mapping[str, Value] = None):
+        self.slot_values: list = []
+        self.stamps: list[int] = []
+        self.extra: dict[str, Value] = {}
+        if items is not None:
+            self.update(items)
+
+    def get_slot(self, slot: int, name: str) -> Value:
+        values = self.slot_values
+        if slot < len(values):
+            v = values[slot]
+            if v is not UNBOUND:
+                return v
+        return self.extra[name]
+
+    def set_slot(self, slot: int, value: Value) -> None:
+        values = self.slot_values
+        if slot >= len(values):
+            missing = len(slots.names) - len(values)
+            values.extend([UNBOUND] * missing)
+            self.stamps.extend([0] * missing)
+        if values[slot] is UNBOUND and self.extra:
+            # written before the name had a slot
+            self.extra.pop(slots.names[slot], None)
+        values[slot] = value
+        self.stamps[slot] = next(_writes)
+
+    def __getitem__(self, key: str) -> Value:
+        slot = slots.slots.get(key)
+        if slot is None:
+            return self.extra[key]
+        return self.get_slot(slot, key)
+
+    def __setitem__(self, key: str, value: Value) -> None:
+        slot = slots.slots.get(key)
+        if slot is None:
+            self.extra[key] = value
+        else:
+            self.set_slot(slot, value)
+
+    def __delitem__(self, key: str) -> None:
+        slot = slots.slots.get(key)
+        if slot is None or slot >= len(self.slot_values) or self.slot_values[slot] is UNBOUND:
+            del self.extra[key]
+        else:
+            self.slot_values[slot] = UNBOUND
+            self.stamps[slot] = next(_writes)
+
+    def __contains__(self, key: object) -> bool:
+        slot = slots.slots.get(key)
+        if slot is not None and slot < len(self.slot_values) and self.slot_values[slot] is not UNBOUND:
+            return True
+        return key in self.extra
+
+    def __iter__(self) -> Iterator[str]:
+        names = slots.names
+        for slot, v in enumerate(self.slot_values):
+            if v is not UNBOUND:
+                yield names[slot]
+        yield from self.extra
+
+    def __len__(self) -> int:
+        return sum(1 for v in self.slot_values if v is not UNBOUND) + len(self.extra)
+
+    def __reduce__(self):
+        # by name: slot numbers depend on the order names were seen in this process
+        return SlotVars, (dict(self),)
+
+    def __deepcopy__(self, memo: dict) -> "SlotVars":
+        memo[id(UNBOUND)] = UNBOUND
+        new = SlotVars()
+        new.slot_values = deepcopy(self.slot_values, memo)
+        new.stamps = self.stamps.copy()
+        new.extra = deepcopy(self.extra, memo)
+        return new
+
+    def __repr__(self) -> str:
+        return f"SlotVars({dict(self)!r})"
 
 
 @dataclass
@@ -248,7 +630,7 @@ class StmtEmit(Statement):
 class Ast(Transformer):
     @staticmethod
     def number(n):
-        return ValueNumber(float(n))
+        return number(float(n))
 
     @staticmethod
     def string(s):
@@ -291,6 +673,10 @@ class Ast(Transformer):
     def div(a, b):
         return ExprBinaryOp(a, "/", b)
 
+    @staticmethod
+    def floordiv(a, b):
+        return ExprBinaryOp(a, "//", b)
+
     @staticmethod
     def neg(n):
         return ExprUnaryOP(n, "-")
@@ -346,15 +732,65 @@ class Ast(Transformer):
         return StmtEmit(expr)
 
 
-stmt_parser = Lark(grammar, parser='lalr', start='statement', transformer=Ast())
-expr_parser = Lark(grammar, parser='lalr', start='expression', transformer=Ast())
-stmt_parser_tree = Lark(grammar, parser='lalr', start='statement')
-expr_parser_tree = Lark(grammar, parser='lalr', start='expression')
+# Lark stores the parser tables here and checks them against a hash of the grammar when loading
+cache_dir = os.environ.get('SCREEPT_CACHE_DIR',
+                           os.path.join(os.path.dirname(os.path.abspath(__file__)), '.screept_cache'))
+
+
+@cache
+def get_parser(start: str, transform: bool = True) -> Lark:
+    """Builds the parser on first use, from the cached tables when there are any"""
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_file: str | bool = os.path.join(cache_dir, f"{start}{'' if transform else '_tree'}.lark")
+    except OSError:
+        cache_file = False
+    return Lark(grammar, parser='lalr', start=start, transformer=Ast() if transform else None, cache=cache_file)
+
+
+_parsers = {'stmt_parser': ('statement', True), 'expr_parser': ('expression', True),
+            'stmt_parser_tree': ('statement', False), 'expr_parser_tree': ('expression', False)}
+
+
+def __getattr__(name: str) -> Lark:
+    # stmt_parser, expr_parser and the _tree variants are built lazily instead of at import time
+    if name in _parsers:
+        return get_parser(*_parsers[name])
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+@lru_cache(maxsize=1024)
+def parse_expression(source: str) -> Expression:
+    """Parses with expr_parser; repeated sources get the same AST back, see parse_expression.cache_info()"""
+    return get_parser('expression').parse(source)
+
+
+@lru_cache(maxsize=1024)
+def parse_statement(source: str) -> Statement:
+    """Parses with stmt_parser; repeated sources get the same AST back, see parse_statement.cache_info()"""
+    return get_parser('statement').parse(source)
 
 
 #
 
 
+# print every name a computed identifier ($[...]) evaluates to
+debug_identifiers = False
+
+
+def resolve_names(node) -> int:
+    """Resolver pass: gives a slot to every literal identifier in the AST, or in any dataclasses or lists holding
+    ASTs, and returns how many identifiers it saw"""
+    if isinstance(node, (list, tuple)):
+        return sum(map(resolve_names, node))
+    if isinstance(node, IdentifierLiteral):
+        slots.slot(node.value)
+        return 1
+    if is_dataclass(node) and not isinstance(node, type):
+        return sum(resolve_names(getattr(node, f.name)) for f in fields(node))
+    return 0
+
+
 def get_literal_value(v: Value) -> str | float:
     match v:
         case ValueNumber(x):
@@ -370,8 +806,10 @@ def get_identifier_value(i: Identifier, env: Environment) -> str:
         case IdentifierLiteral(x):
             return x
         case IdentifierComputed(x):
-            print("ID "+repr(i),(evaluate_expression(x, env)).get_string())
-            return (evaluate_expression(x, env)).get_string()
+            name = evaluate_expression(x, env).get_string()
+            if debug_identifiers:
+                print("ID " + repr(i), name)
+            return name
         case _:
             raise Exception("Wrong identifier"+repr(i))
 
@@ -385,13 +823,11 @@ def get_numerical_value(v: Value) -> float:
 
 
 def evaluate_expression(e: Expression, env: Environment) -> Value:
+    if profiler is not None:
+        profiler.node()
     match e:
-        case ValueNumber(v):
-            return ValueNumber(v)
-        case ValueString(v):
-            return ValueString(v)
-        case ValueFunction(v):
-            return ValueFunction(v)
+        case Value():
+            return e
         case ExprBinaryOp(left, op, right):
             from operator import sub, mul, truediv, floordiv
             ev_left = evaluate_expression(left, env)
@@ -401,7 +837,7 @@ def evaluate_expression(e: Expression, env: Environment) -> Value:
 
                     match (ev_left, ev_right):
                         case (ValueNumber(ll), ValueNumber(rr)):
-                            return ValueNumber(ll + rr)
+                            return number(ll + rr)
                         case _:
                             return ValueString(ev_left.get_string() + ev_right.get_string())
 
@@ -416,48 +852,44 @@ def evaluate_expression(e: Expression, env: Environment) -> Value:
                 case _:
                     raise Exception("Unknown binary: " + op)
 
-            return ValueNumber(binary(ev_left.get_number(), ev_right.get_number()))
+            return number(binary(ev_left.get_number(), ev_right.get_number()))
         case ExpressionVar(i):
 
             return env.vars[get_identifier_value(i, env)]
         case ExprUnaryOP(left, op):
             match op:
                 case "-":
-                    return ValueNumber(-evaluate_expression(left, env).get_number())
+                    return number(-evaluate_expression(left, env).get_number())
                 case "!":
                     if evaluate_expression(left, env).get_number():
-                        return ValueNumber(0)
+                        return FALSE
                     else:
-                        return ValueNumber(1)
+                        return TRUE
                 case _:
                     raise Exception("Unknown Unary" + op)
         case ExprFuncCall(i, args):
-            func = env.vars[get_identifier_value(i, env)]
-            if isinstance(func, ValueFunction):
-                new_env = environment_with_args(env, args)
-
-                return evaluate_expression(func.value, new_env)
-
-            raise Exception
+            if profiler is not None:
+                return profiler.call("func", i, _call_function, i, args, env)
+            return _call_function(i, args, env)
         case ExprComparisonEqual(left, right):
             if evaluate_expression(left, env) == evaluate_expression(right, env):
-                return ValueNumber(1)
+                return TRUE
             else:
-                return ValueNumber(0)
+                return FALSE
         case ExprComparisonLess(left, right):
             if evaluate_expression(left, env).get_number() < evaluate_expression(right, env).get_number():
-                return ValueNumber(1)
+                return TRUE
             else:
-                return ValueNumber(0)
+                return FALSE
         case ExprComparisonMore(left, right):
             if evaluate_expression(left, env).get_number() > evaluate_expression(right, env).get_number():
-                return ValueNumber(1)
+                return TRUE
             else:
-                return ValueNumber(0)
+                return FALSE
 
         case ExprConditional(cond, if_true, if_false):
             ec = evaluate_expression(cond, env)
-            if ec == ValueNumber(0):
+            if ec == ZERO:
                 return evaluate_expression(if_false, env)
             else:
                 return evaluate_expression(if_true, env)
@@ -465,19 +897,37 @@ def evaluate_expression(e: Expression, env: Environment) -> Value:
             raise Exception("Can't handle EXPR ", e)
 
 
+def _call_function(i: Identifier, args: Sequence[Expression], env: Environment) -> Value:
+    func = env.vars[get_identifier_value(i, env)]
+    if isinstance(func, ValueFunction):
+        new_env = environment_with_args(env, args)
+
+        return evaluate_expression(func.value, new_env)
+
+    raise Exception
+
+
 def environment_with_args(env: Environment, args: Sequence[ExprLiteralValue]) -> Environment:
-    new_env = deepcopy(env)
-    for i, arg in enumerate(args):
-        new_env.vars['_' + str(i)] = evaluate_expression(arg, env)
-    return new_env
+    return scoped_environment(env, [evaluate_expression(arg, env) for arg in args])
+
+
+def scoped_environment(env: Environment, values: Sequence[Value]) -> Environment:
+    frame = {'_' + str(i): v for i, v in enumerate(values)}
+    parent = env.vars
+    if isinstance(parent, Scope):
+        # A caller's frame only holds its own `_0.._n`, so merging it in keeps chains one level deep
+        # however deep the calls nest.
+        frame = parent.frame | frame
+        parent = parent.parent
+    return Environment(Scope(frame, parent), env.procedures, env.output, env.rng)
 
 
 def run_statement(s: Statement, env: Environment, emit_handler: Callable[[str], None] = lambda x: None) -> None:
+    if profiler is not None:
+        profiler.node()
     match s:
         case StmtPrint(e):
-            res = evaluate_expression(e, env)
-            env.output.append(res.get_string())
-            print("PRINT ", evaluate_expression(e, env))
+            env.output.append(evaluate_expression(e, env).get_string())
         case StmtBind(i, e):
             v = evaluate_expression(e, env)
             env.vars[get_identifier_value(i, env)] = v
@@ -487,16 +937,15 @@ def run_statement(s: Statement, env: Environment, emit_handler: Callable[[str],
         case StmtProcDef(i, stmt):
             env.procedures[get_identifier_value(i, env)] = stmt
         case StmtProcRun(i, args):
-            stmt = env.procedures[get_identifier_value(i, env)]
-            for i, arg in enumerate(args):
-                env.vars['_' + str(i)] = evaluate_expression(arg, env)
-
-            run_statement(stmt, env, emit_handler)
+            if profiler is not None:
+                profiler.call("proc", i, _run_procedure, i, args, env, emit_handler)
+            else:
+                _run_procedure(i, args, env, emit_handler)
         case StmtRnd(i, minVal, maxVal):
             min_v = get_numerical_value(evaluate_expression(minVal, env))
             max_v = get_numerical_value(evaluate_expression(maxVal, env))
 
-            env.vars[get_identifier_value(i, env)] = ValueNumber(random.randint(floor(min_v), floor(max_v)))
+            env.vars[get_identifier_value(i, env)] = number(env.rng.randint(floor(min_v), floor(max_v)))
         case StmtIf(cond, if_true, if_false):
             if evaluate_expression(cond, env).get_number():
                 run_statement(if_true, env, emit_handler)
@@ -511,6 +960,27 @@ def run_statement(s: Statement, env: Environment, emit_handler: Callable[[str],
             raise Exception("unknown statement", s)
 
 
+def _run_procedure(i: Identifier, args: Sequence[Expression], env: Environment,
+                   emit_handler: Callable[[str], None]) -> None:
+    stmt = env.procedures[get_identifier_value(i, env)]
+    for n, arg in enumerate(args):
+        env.vars['_' + str(n)] = evaluate_expression(arg, env)
+
+    run_statement(stmt, env, emit_handler)
+
+
+# the active screept_profiler.Profiler, see set_profiler
+profiler = None
+
+
+def set_profiler(new) -> None:
+    """Makes a screept_profiler.Profiler see every function call and procedure run, in the tree-walker and in the
+    compiled closures of screept_compiler, however the functions were imported. None turns it off again; a
+    disabled profiler costs one check per call, and per node in the tree-walker."""
+    global profiler
+    profiler = new
+
+
 def test_emit_handler(s: str) -> None:
     print("EMITTED", s)
 
@@ -532,10 +1002,10 @@ def test():
     # expr2 = """ $[ "a"+"b"+"c"] + 5 """
     expr2 = """fun1(2,3)==6?1:0"""
     # parsed3 = calc2(expr2)
-    parsed3 = expr_parser.parse(expr2)
+    parsed3 = parse_expression(expr2)
     print("S", parsed3)
     print("EV", evaluate_expression(parsed3, env))
-    parsed = expr_parser.parse(expr)
+    parsed = parse_expression(expr)
     print(parsed)
     s1 = """{ g=FUNC _0 + _1;
     PROC janowa { PRINT _0 ; a66=5 };
@@ -549,7 +1019,7 @@ def test():
      IF xx<8 THEN PRINT "XX"+xx ELSE PRINT "YYY"+xx;
      EMIT xx
      }"""
-    sp1 = stmt_parser.parse(s1)
+    sp1 = parse_statement(s1)
     print(sp1)
     run_statement(sp1, env, test_emit_handler)
     pprint(env)
@@ -557,13 +1027,92 @@ def test():
     # s1 = stmt_parser.parse()
 
 
+def benchmark_call(sizes: Sequence[int] = (10, 1000, 100000), iterations: int = 10000):
+    # the cost of a call must not grow with the number of vars in the environment
+    call = parse_expression("f(1,2)")
+    for size in sizes:
+        env = Environment({'v' + str(n): ValueNumber(n) for n in range(size)}, {}, [])
+        env.vars['f'] = ValueFunction(parse_expression("_0 + _1"))
+        start = time.perf_counter()
+        for _ in range(iterations):
+            evaluate_expression(call, env)
+        print(f"{size} vars: {(time.perf_counter() - start) / iterations * 1e6:.2f}us per call")
+
+
+def benchmark_allocations(iterations: int = 20000):
+    """Memory held by the results of evaluating, and gen 0 collections triggered, measured with tracemalloc and gc"""
+    env = Environment({'turn': ValueNumber(250), 'money': ValueNumber(100), 'stamina': ValueNumber(70),
+                       'mod': ValueFunction(parse_expression("_0 - (_0 // _1) * _1")),
+                       'hour': ValueFunction(parse_expression("mod(turn // 2, 24) > 12 ? 1 : 0"))}, {}, [])
+    expressions = [parse_expression(source) for source in
+                   ["stamina > 9", "money < 5", "turn == 250", "hour()", "(stamina > 9) ? 1 : 0", "0", "1"]]
+    collections = []
+
+    def on_gc(phase, info):
+        if phase == 'start' and info['generation'] == 0:
+            collections.append(1)
+
+    results = []
+    gc.collect()
+    gc.callbacks.append(on_gc)
+    tracemalloc.start()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for e in expressions:
+            results.append(evaluate_expression(e, env))
+    elapsed = time.perf_counter() - start
+    held, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    gc.callbacks.remove(on_gc)
+    count = iterations * len(expressions)
+    print(f"{held / count:.1f} bytes held per evaluation, peak {peak} bytes, {len(collections)} gen 0 collections, "
+          f"{elapsed / count * 1e6:.2f}us per evaluation")
+
+
+def benchmark_output(iterations: int = 200000):
+    """Memory held after printing continuously, with the default list and with the sinks"""
+    loop = parse_statement('{ n = n + 1; PRINT "line " + n }')
+    for name, output in [("list", []), ("ring buffer", RingBufferSink(1000)), ("null", NullSink())]:
+        env = Environment({'n': ValueNumber(0)}, {}, output)
+        tracemalloc.start()
+        for _ in range(iterations):
+            run_statement(loop, env)
+        held, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{name}: {held} bytes held after {iterations} PRINTs, peak {peak} bytes")
+
+
+def benchmark_rnd(iterations: int = 20000):
+    """RUN combat from fable, drawing from the shared random module and from an Environment's own stream"""
+    import dialogs
+    import screept_compiler
+    env = dialogs.load_game("fable").game_state.environment
+    # an enemy that outlasts the benchmark
+    screept_compiler.run_statement(parse_statement("{ _enemy_attack = 4; _enemy_defence = 8; _enemy_damage = 2; "
+                                                   "_enemy_combat = 4; _enemy_stamina = 1000000; "
+                                                   "combat_player_success = FUNC 0; combat_player_failure = FUNC 0 }"),
+                                   env)
+    rolls = parse_statement("{ RND a 1 6; RND b 1 6; RND c 1 6; RND d 1 6 }")
+    for title, stmt in [("combat round", parse_statement("RUN combat()")), ("4 RNDs", rolls)]:
+        # anything with randint will do as the stream, random.Random is what RND used before
+        for name, rng in [("random.Random", random.Random(1)), ("Rng, one at a time", Rng(1, 1)),
+                          ("Rng, NumPy blocks", Rng(1))]:
+            run_env = deepcopy(env)
+            run_env.rng = rng
+            start = time.perf_counter()
+            for _ in range(iterations):
+                screept_compiler.run_statement(stmt, run_env)
+            elapsed = time.perf_counter() - start
+            print(f"{title}, {name}: {elapsed / iterations * 1e6:.2f}us")
+
+
 def main():
     while True:
         try:
             s = input('> ')
         except EOFError:
             break
-        print(expr_parser.parse(s))
+        print(parse_expression(s))
 
 
 if __name__ == '__main__':
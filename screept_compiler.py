@@ -0,0 +1,500 @@
+"""
+Screept compiler
+================
+
+Turns Screept ASTs into nested Python closures once, so the big ``match`` in
+``screept.evaluate_expression`` / ``screept.run_statement`` is not repeated on
+every evaluation. The tree-walker in ``screept`` stays the reference mode and
+the closures here must give the same results.
+"""
+import time
+from collections import OrderedDict
+from collections.abc import Callable, Sequence
+from copy import deepcopy
+from math import floor
+from operator import sub, mul, truediv, floordiv
+from typing import Optional
+
+import screept
+import screept_memo
+from screept import (Expression, Statement, Environment, Identifier, Value, IdentifierLiteral, IdentifierComputed,
+                     ExpressionVar, ValueNumber, ValueString, ValueFunction, ExprFuncCall, ExprBinaryOp, ExprUnaryOP,
+                     ExprConditional, ExprComparisonEqual, ExprComparisonLess, ExprComparisonMore, StmtPrint,
+                     StmtBlock, StmtBind, StmtProcDef, StmtProcRun, StmtRnd, StmtIf, StmtEmit, get_numerical_value,
+                     scoped_environment, number, TRUE, FALSE, Scope, SlotVars, slots, UNBOUND, OutOfFuel,
+                     DeadlineExceeded)
+
+CompiledExpression = Callable[[Environment], Value]
+CompiledStatement = Callable[[Environment, Callable[[str], None]], None]
+CompiledIdentifier = Callable[[Environment], str]
+
+# id(node) -> (node, compiled), least recently used first. Keeping the node alive means its id can't be reused
+# while it is in here; past COMPILED_MAX nodes the oldest are dropped, so ASTs parsed at run time don't pile up.
+COMPILED_MAX = 16384
+_compiled: OrderedDict[int, tuple[object, Callable]] = OrderedDict()
+
+# calls to pure functions go through it, None turns memoization off
+memo: Optional[screept_memo.Memo] = screept_memo.Memo()
+
+
+class Budget:
+    """Fuel and a deadline for compiled code, in force inside `with`. Every function or procedure call spends one
+    unit of fuel and checks the clock, which starts at the first call; code without calls runs in time linear in
+    its size anyway. Spending from a nested budget spends from the one around it too."""
+    __slots__ = ('fuel', 'timeout', 'deadline', 'calls', 'parent')
+
+    def __init__(self, fuel: Optional[int] = None, timeout: Optional[float] = None):
+        self.fuel = fuel
+        self.timeout = timeout
+        self.deadline: Optional[float] = None
+        self.calls = 0
+        self.parent: Optional[Budget] = None
+
+    def __enter__(self) -> "Budget":
+        global budget
+        self.parent = budget
+        budget = self
+        return self
+
+    def __exit__(self, *exc) -> None:
+        global budget
+        budget = self.parent
+
+    def spend(self) -> None:
+        self.calls += 1
+        if self.fuel is not None and self.calls > self.fuel:
+            raise OutOfFuel(f"ran out of fuel after {self.fuel} calls")
+        if self.timeout is not None:
+            now = time.monotonic()
+            if self.deadline is None:
+                self.deadline = now + self.timeout
+            elif now > self.deadline:
+                raise DeadlineExceeded(f"deadline passed after {self.calls} calls")
+        if self.parent is not None:
+            self.parent.spend()
+
+
+# what calls spend, None for no limit; set with limited(). One per process, like memo.
+budget: Optional[Budget] = None
+
+
+def limited(fuel: Optional[int] = None, timeout: Optional[float] = None) -> Budget:
+    """Limits the compiled code run inside to `fuel` calls and `timeout` seconds:
+
+        with limited(fuel=10000):
+            run_statement(stmt, env)  # OutOfFuel on the 10001st call
+    """
+    return Budget(fuel, timeout)
+
+_binary_ops = {"-": sub, "*": mul, "/": truediv, "//": floordiv}
+
+
+def _raising(exc: Exception) -> Callable:
+    # Errors are raised when the node is evaluated, like in the tree-walker, not when it is compiled
+    def fail(*_):
+        raise exc
+
+    return fail
+
+
+def _call(body: Expression, values: Sequence[Value], env: Environment) -> Value:
+    return compile_cached(body)(scoped_environment(env, values))
+
+
+def _call_function(func: ValueFunction, ev_args: Sequence[CompiledExpression], env: Environment) -> Value:
+    values = [arg(env) for arg in ev_args]
+    if memo is not None:
+        return memo.call(func, values, env, _call)
+    return compile_cached(func.value)(scoped_environment(env, values))
+
+
+def _run_procedure(stmt: Statement, ev_args: Sequence[CompiledExpression], env: Environment,
+                   emit_handler: Callable[[str], None]) -> None:
+    for n, arg in enumerate(ev_args):
+        env.vars['_' + str(n)] = arg(env)
+    compile_cached(stmt)(env, emit_handler)
+
+
+def compile_identifier(i: Identifier) -> CompiledIdentifier:
+    match i:
+        case IdentifierLiteral(x):
+            return lambda env: x
+        case IdentifierComputed(x):
+            value = compile_expression(x)
+
+            def computed(env: Environment) -> str:
+                name = value(env).get_string()
+                if screept.debug_identifiers:
+                    print("ID " + repr(i), name)
+                return name
+
+            return computed
+        case _:
+            return _raising(Exception("Wrong identifier" + repr(i)))
+
+
+def compile_expression(e: Expression) -> CompiledExpression:
+    match e:
+        case Value():
+            return lambda env: e
+        case ExprBinaryOp(left, "+", right):
+            ev_left = compile_expression(left)
+            ev_right = compile_expression(right)
+
+            def add(env: Environment) -> Value:
+                ll = ev_left(env)
+                rr = ev_right(env)
+                if ll.__class__ is ValueNumber and rr.__class__ is ValueNumber:
+                    return number(ll.value + rr.value)
+                return ValueString(ll.get_string() + rr.get_string())
+
+            return add
+        case ExprBinaryOp(left, op, right):
+            if op not in _binary_ops:
+                return _raising(Exception("Unknown binary: " + op))
+            binary = _binary_ops[op]
+            ev_left = compile_expression(left)
+            ev_right = compile_expression(right)
+            return lambda env: number(binary(ev_left(env).get_number(), ev_right(env).get_number()))
+        case ExpressionVar(IdentifierLiteral(name)):
+            slot = slots.slot(name)
+            if slot is None:
+                return lambda env: env.vars[name]
+
+            def var(env: Environment) -> Value:
+                store = env.vars
+                if store.__class__ is dict:
+                    return store[name]
+                try:
+                    v = store.slot_values[slot]
+                except (AttributeError, TypeError, IndexError):
+                    # not slot-backed, or the name got its slot after the store was filled
+                    return store[name]
+                if v is UNBOUND:
+                    # missing, or written before the name had a slot
+                    return store[name]
+                return v
+
+            return var
+        case ExpressionVar(i):
+            identifier = compile_identifier(i)
+            return lambda env: env.vars[identifier(env)]
+        case ExprUnaryOP(left, "-"):
+            ev_left = compile_expression(left)
+            return lambda env: number(-ev_left(env).get_number())
+        case ExprUnaryOP(left, "!"):
+            ev_left = compile_expression(left)
+            return lambda env: FALSE if ev_left(env).get_number() else TRUE
+        case ExprUnaryOP(_, op):
+            return _raising(Exception("Unknown Unary" + op))
+        case ExprFuncCall(i, args):
+            identifier = compile_identifier(i)
+            ev_args = tuple(map(compile_expression, args))
+
+            def call(env: Environment) -> Value:
+                func = env.vars[identifier(env)]
+                if isinstance(func, ValueFunction):
+                    if budget is not None:
+                        budget.spend()
+                    if screept.profiler is not None:
+                        return screept.profiler.call("func", i, _call_function, func, ev_args, env)
+                    # _call_function inlined
+                    values = [arg(env) for arg in ev_args]
+                    if memo is not None:
+                        return memo.call(func, values, env, _call)
+                    return compile_cached(func.value)(scoped_environment(env, values))
+                raise Exception
+
+            return call
+        case ExprComparisonEqual(left, right):
+            ev_left = compile_expression(left)
+            ev_right = compile_expression(right)
+            return lambda env: TRUE if ev_left(env) == ev_right(env) else FALSE
+        case ExprComparisonLess(left, right):
+            ev_left = compile_expression(left)
+            ev_right = compile_expression(right)
+            return lambda env: TRUE if ev_left(env).get_number() < ev_right(env).get_number() \
+                else FALSE
+        case ExprComparisonMore(left, right):
+            ev_left = compile_expression(left)
+            ev_right = compile_expression(right)
+            return lambda env: TRUE if ev_left(env).get_number() > ev_right(env).get_number() \
+                else FALSE
+        case ExprConditional(cond, if_true, if_false):
+            ev_cond = compile_expression(cond)
+            ev_true = compile_expression(if_true)
+            ev_false = compile_expression(if_false)
+
+            def conditional(env: Environment) -> Value:
+                ec = ev_cond(env)
+                # same as `ec == ValueNumber(0)` in the tree-walker
+                if ec.__class__ is ValueNumber and ec.value == 0:
+                    return ev_false(env)
+                return ev_true(env)
+
+            return conditional
+        case _:
+            return _raising(Exception("Can't handle EXPR ", e))
+
+
+def compile_statement(s: Statement) -> CompiledStatement:
+    match s:
+        case StmtPrint(e):
+            ev = compile_expression(e)
+            return lambda env, emit_handler: env.output.append(ev(env).get_string())
+        case StmtBind(IdentifierLiteral(name), e) if slots.slot(name) is not None:
+            slot = slots.slot(name)
+            ev = compile_expression(e)
+
+            def bind_slot(env: Environment, emit_handler: Callable[[str], None]) -> None:
+                v = ev(env)
+                store = env.vars
+                if store.__class__ is SlotVars:
+                    store.set_slot(slot, v)
+                else:
+                    store[name] = v
+
+            return bind_slot
+        case StmtBind(i, e):
+            identifier = compile_identifier(i)
+            ev = compile_expression(e)
+
+            def bind(env: Environment, emit_handler: Callable[[str], None]) -> None:
+                v = ev(env)
+                env.vars[identifier(env)] = v
+
+            return bind
+        case StmtBlock(ss):
+            statements = tuple(map(compile_statement, ss))
+
+            def block(env: Environment, emit_handler: Callable[[str], None]) -> None:
+                for st in statements:
+                    st(env, emit_handler)
+
+            return block
+        case StmtProcDef(i, stmt):
+            identifier = compile_identifier(i)
+
+            def proc_def(env: Environment, emit_handler: Callable[[str], None]) -> None:
+                # procedures are stored as ASTs so environments stay interchangeable with the tree-walker
+                env.procedures[identifier(env)] = stmt
+
+            return proc_def
+        case StmtProcRun(i, args):
+            identifier = compile_identifier(i)
+            ev_args = tuple(map(compile_expression, args))
+
+            def proc_run(env: Environment, emit_handler: Callable[[str], None]) -> None:
+                stmt = env.procedures[identifier(env)]
+                if budget is not None:
+                    budget.spend()
+                if screept.profiler is not None:
+                    screept.profiler.call("proc", i, _run_procedure, stmt, ev_args, env, emit_handler)
+                    return
+                for n, arg in enumerate(ev_args):
+                    env.vars['_' + str(n)] = arg(env)
+                compile_cached(stmt)(env, emit_handler)
+
+            return proc_run
+        case StmtRnd(IdentifierLiteral(name), min_val, max_val) if slots.slot(name) is not None:
+            slot = slots.slot(name)
+            ev_min = compile_expression(min_val)
+            ev_max = compile_expression(max_val)
+
+            def rnd_slot(env: Environment, emit_handler: Callable[[str], None]) -> None:
+                min_v = ev_min(env)
+                max_v = ev_max(env)
+                # get_numerical_value inlined: anything but a number counts as 0
+                min_v = floor(min_v.value) if min_v.__class__ is ValueNumber else 0
+                max_v = floor(max_v.value) if max_v.__class__ is ValueNumber else 0
+                v = number(env.rng.randint(min_v, max_v))
+                store = env.vars
+                if store.__class__ is SlotVars:
+                    store.set_slot(slot, v)
+                else:
+                    store[name] = v
+
+            return rnd_slot
+        case StmtRnd(i, min_val, max_val):
+            identifier = compile_identifier(i)
+            ev_min = compile_expression(min_val)
+            ev_max = compile_expression(max_val)
+
+            def rnd(env: Environment, emit_handler: Callable[[str], None]) -> None:
+                min_v = get_numerical_value(ev_min(env))
+                max_v = get_numerical_value(ev_max(env))
+                env.vars[identifier(env)] = number(env.rng.randint(floor(min_v), floor(max_v)))
+
+            return rnd
+        case StmtIf(cond, if_true, if_false):
+            ev_cond = compile_expression(cond)
+            run_true = compile_statement(if_true)
+            run_false = None if if_false is None else compile_statement(if_false)
+
+            def stmt_if(env: Environment, emit_handler: Callable[[str], None]) -> None:
+                if ev_cond(env).get_number():
+                    run_true(env, emit_handler)
+                elif run_false is not None:
+                    run_false(env, emit_handler)
+
+            return stmt_if
+        case StmtEmit(e):
+            ev = compile_expression(e)
+            return lambda env, emit_handler: emit_handler(ev(env).get_string())
+        case _:
+            return _raising(Exception("unknown statement", s))
+
+
+def compile_cached(node: Expression | Statement) -> Callable:
+    key = id(node)
+    hit = _compiled.get(key)
+    if hit is not None:
+        _compiled.move_to_end(key)
+        return hit[1]
+    compiled = compile_statement(node) if isinstance(node, Statement) else compile_expression(node)
+    _compiled[key] = (node, compiled)
+    if len(_compiled) > COMPILED_MAX:
+        _compiled.popitem(last=False)
+    return compiled
+
+
+def evaluate_expression(e: Expression, env: Environment) -> Value:
+    """Drop-in replacement for screept.evaluate_expression"""
+    return compile_cached(e)(env)
+
+
+def run_statement(s: Statement, env: Environment, emit_handler: Callable[[str], None] = lambda x: None,
+                  fuel: Optional[int] = None, timeout: Optional[float] = None) -> None:
+    """Drop-in replacement for screept.run_statement, optionally limited to `fuel` calls or `timeout` seconds"""
+    if fuel is None and timeout is None:
+        compile_cached(s)(env, emit_handler)
+    else:
+        with limited(fuel, timeout):
+            compile_cached(s)(env, emit_handler)
+
+
+#
+
+
+def _game_expressions(title: str):
+    import dialogs
+    game = dialogs.load_game(title)
+    env = game.game_state.environment
+    expressions = []
+    for dialog in game.dialogs.values():
+        expressions.append(dialog.text)
+        for option in dialog.options:
+            expressions.append(option.text)
+            if option.condition is not None:
+                expressions.append(option.condition)
+    if '__statusLine' in env.vars:
+        expressions.append(screept.parse_expression('__statusLine()'))
+    return game, expressions
+
+
+def _outcome(evaluate, e, env):
+    try:
+        return evaluate(e, env)
+    except Exception as ex:
+        return repr(ex)
+
+
+def test():
+    import dialogs
+    for title in ["customGame", "fable"]:
+        game, expressions = _game_expressions(title)
+        env = game.game_state.environment
+        for e in expressions:
+            assert _outcome(evaluate_expression, e, env) == _outcome(screept.evaluate_expression, e, env), e
+        for dialog in game.dialogs.values():
+            for option in dialog.options:
+                for action in option.actions:
+                    if not isinstance(action, dialogs.DAScreept):
+                        continue
+                    results = []
+                    for run in [screept.run_statement, run_statement]:
+                        # the copy has its own Rng at the same point, so both runs draw the same numbers
+                        run_env = deepcopy(env)
+                        try:
+                            run(action.value, run_env)
+                        except Exception as ex:
+                            results.append(repr(ex))
+                        else:
+                            results.append(run_env)
+                    assert results[0] == results[1], action
+    # expressions parsed on the fly don't stay cached for ever
+    for n in range(COMPILED_MAX + 10):
+        evaluate_expression(screept.parse_expression(str(n)), env)
+    assert len(_compiled) == COMPILED_MAX
+
+    # names computed at run time get no slot; one that gets its slot later is still found where it was written
+    stmt = screept.parse_statement('{ i = "0"; $["testItem" + i] = 1; $["testLate" + i] = 2 }')
+    compile_cached(stmt)
+    known = len(slots.names)
+    env = Environment(SlotVars(), {}, [])
+    run_statement(stmt, env)
+    assert len(slots.names) == known and set(env.vars.extra) == {"testItem0", "testLate0"}
+    assert evaluate_expression(screept.parse_expression("testLate0"), env) == ValueNumber(2)
+    run_statement(screept.parse_statement("testLate0 = testLate0 + 1"), env)
+    assert set(env.vars.extra) == {"testItem0"} and dict(env.vars) == {
+        "i": ValueString("0"), "testItem0": ValueNumber(1), "testLate0": ValueNumber(3)}
+
+    # a procedure running itself forever, and a function making 2^_0 calls, looked up by a computed identifier
+    # so they are not memoized
+    forever = screept.parse_statement("{ PROC loop { n = n + 1; RUN loop() }; RUN loop() }")
+    env = Environment({"n": ValueNumber(0), "f": ValueFunction(screept.parse_expression(
+        '_0 > 0 ? $["f"](_0 - 1) + $["f"](_0 - 1) : 1'))}, {}, [])
+    for run, error in [(lambda: run_statement(forever, env, fuel=100), OutOfFuel),
+                       (lambda: run_statement(screept.parse_statement("x = f(40)"), env, timeout=0.05),
+                        DeadlineExceeded)]:
+        try:
+            run()
+        except error:
+            pass
+        else:
+            assert False
+    assert budget is None
+    # an outer budget bounds what inner ones spend
+    with limited(fuel=100) as outer:
+        with limited(fuel=1000):
+            try:
+                run_statement(forever, env)
+            except OutOfFuel as e:
+                assert outer.calls == 101, e
+    print("OK")
+
+
+def benchmark(iterations: int = 200):
+    for title in ["customGame", "fable"]:
+        game, expressions = _game_expressions(title)
+        env = game.game_state.environment
+        timings = []
+        for evaluate in [screept.evaluate_expression, evaluate_expression]:
+            start = time.perf_counter()
+            for _ in range(iterations):
+                for e in expressions:
+                    _outcome(evaluate, e, env)
+            timings.append(time.perf_counter() - start)
+        print(f"{title}: tree-walker {timings[0]:.3f}s compiled {timings[1]:.3f}s "
+              f"speedup {timings[0] / timings[1]:.1f}x")
+
+
+def benchmark_slots(iterations: int = 2000):
+    import dialogs
+    game = dialogs.load_game("customGame")
+    env = game.game_state.environment
+    expressions = [screept.parse_expression('__statusLine()')] + [o.condition for d in game.dialogs.values()
+                                                                 for o in d.options if o.condition is not None]
+    expressions.append(screept.parse_expression(" + ".join(["turn", "money", "stamina", "day", "hour"] * 10)))
+    for store in [dict(env.vars), env.vars]:
+        store_env = Environment(store, env.procedures, [])
+        start = time.perf_counter()
+        for _ in range(iterations):
+            for e in expressions:
+                evaluate_expression(e, store_env)
+        print(f"{type(store).__name__}: {time.perf_counter() - start:.3f}s")
+
+
+if __name__ == '__main__':
+    test()
+    benchmark()
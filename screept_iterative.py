@@ -0,0 +1,393 @@
+"""
+Screept iterative evaluator
+================
+
+Evaluates Screept with an explicit stack of tasks instead of Python recursion,
+so arbitrarily deep ASTs (long ``+`` chains, nested ``IF``/blocks, deep call
+chains) run in bounded Python stack space. Results match the tree-walker in
+``screept``.
+"""
+import random
+import sys
+import time
+from collections import deque
+from collections.abc import Callable, Iterator
+from math import floor
+from operator import sub, mul, truediv, floordiv
+from typing import Optional
+
+import screept
+from screept import (Expression, Statement, Environment, Value, IdentifierLiteral, IdentifierComputed,
+                     ExpressionVar, ValueNumber, ValueString, ValueFunction, ExprFuncCall, ExprBinaryOp, ExprUnaryOP,
+                     ExprConditional, ExprComparisonEqual, ExprComparisonLess, ExprComparisonMore, StmtPrint,
+                     StmtBlock, StmtBind, StmtProcDef, StmtProcRun, StmtRnd, StmtIf, StmtEmit, get_numerical_value,
+                     scoped_environment, number, TRUE, FALSE, ZERO, OutOfFuel, DeadlineExceeded)
+
+# Task kinds. Every task is a tuple starting with its kind; the ones other than EVAL/EXEC/NAME/PUSH
+# take their operands from the value stack.
+EVAL = 0  # (EVAL, expression, env)
+EXEC = 1  # (EXEC, statement, env)
+NAME = 2  # (NAME, identifier, env) pushes the name as a str
+PUSH = 3  # (PUSH, value)
+TO_NAME = 4  # (TO_NAME, identifier)
+LOOKUP = 5  # (LOOKUP, env)
+BINARY = 6  # (BINARY, op)
+UNARY = 7  # (UNARY, op)
+EQUAL = 8
+LESS = 9
+MORE = 10
+CONDITIONAL = 11  # (CONDITIONAL, if_true, if_false, env)
+CALL_LOOKUP = 12  # (CALL_LOOKUP, args, env)
+CALL = 13  # (CALL, function, arg count, env)
+PRINT = 14  # (PRINT, env)
+STORE = 15  # (STORE, env)
+PROC_DEF = 16  # (PROC_DEF, statement, env)
+PROC_RUN = 17  # (PROC_RUN, args, env)
+RND = 18  # (RND, env)
+IF = 19  # (IF, if_true, if_false, env)
+EMIT = 20  # (EMIT,)
+
+_binary_ops = {"-": sub, "*": mul, "/": truediv, "//": floordiv}
+
+
+def _binary(op: str, ev_left: Value, ev_right: Value) -> Value:
+    if op == "+":
+        if ev_left.__class__ is ValueNumber and ev_right.__class__ is ValueNumber:
+            return number(ev_left.value + ev_right.value)
+        return ValueString(ev_left.get_string() + ev_right.get_string())
+    if op not in _binary_ops:
+        raise Exception("Unknown binary: " + op)
+    return number(_binary_ops[op](ev_left.get_number(), ev_right.get_number()))
+
+
+def _expand_expression(e: Expression, env: Environment, tasks: list, values: list) -> None:
+    match e:
+        case Value():
+            values.append(e)
+        case ExpressionVar(IdentifierLiteral(name)):
+            values.append(env.vars[name])
+        case ExprBinaryOp(left, op, right):
+            tasks += [(BINARY, op), (EVAL, right, env), (EVAL, left, env)]
+        case ExpressionVar(i):
+            tasks += [(LOOKUP, env), (NAME, i, env)]
+        case ExprUnaryOP(left, op):
+            tasks += [(UNARY, op), (EVAL, left, env)]
+        case ExprFuncCall(i, args):
+            tasks += [(CALL_LOOKUP, args, env), (NAME, i, env)]
+        case ExprComparisonEqual(left, right):
+            tasks += [(EQUAL,), (EVAL, right, env), (EVAL, left, env)]
+        case ExprComparisonLess(left, right):
+            tasks += [(LESS,), (EVAL, right, env), (EVAL, left, env)]
+        case ExprComparisonMore(left, right):
+            tasks += [(MORE,), (EVAL, right, env), (EVAL, left, env)]
+        case ExprConditional(cond, if_true, if_false):
+            tasks += [(CONDITIONAL, if_true, if_false, env), (EVAL, cond, env)]
+        case _:
+            raise Exception("Can't handle EXPR ", e)
+
+
+def _expand_statement(s: Statement, env: Environment, tasks: list) -> None:
+    match s:
+        case StmtPrint(e):
+            tasks += [(PRINT, env), (EVAL, e, env)]
+        case StmtBind(i, e):
+            tasks += [(STORE, env), (NAME, i, env), (EVAL, e, env)]
+        case StmtBlock(ss):
+            tasks += [(EXEC, st, env) for st in reversed(ss)]
+        case StmtProcDef(i, stmt):
+            tasks += [(PROC_DEF, stmt, env), (NAME, i, env)]
+        case StmtProcRun(i, args):
+            tasks += [(PROC_RUN, args, env), (NAME, i, env)]
+        case StmtRnd(i, min_val, max_val):
+            tasks += [(RND, env), (NAME, i, env), (EVAL, max_val, env), (EVAL, min_val, env)]
+        case StmtIf(cond, if_true, if_false):
+            tasks += [(IF, if_true, if_false, env), (EVAL, cond, env)]
+        case StmtEmit(e):
+            tasks += [(EMIT,), (EVAL, e, env)]
+        case _:
+            raise Exception("unknown statement", s)
+
+
+def _run(tasks: list, values: list, emit_handler: Callable[[str], None], steps: int = -1) -> int:
+    """Runs up to `steps` tasks, all of them when negative, and returns how many were run"""
+    push = values.append
+    pop = values.pop
+    done = 0
+    while tasks and done != steps:
+        done += 1
+        task = tasks.pop()
+        kind = task[0]
+        if kind == EVAL:
+            _expand_expression(task[1], task[2], tasks, values)
+        elif kind == BINARY:
+            ev_right = pop()
+            push(_binary(task[1], pop(), ev_right))
+        elif kind == EXEC:
+            _expand_statement(task[1], task[2], tasks)
+        elif kind == NAME:
+            match task[1]:
+                case IdentifierLiteral(x):
+                    push(x)
+                case IdentifierComputed(x):
+                    tasks += [(TO_NAME, task[1]), (EVAL, x, task[2])]
+                case i:
+                    raise Exception("Wrong identifier" + repr(i))
+        elif kind == PUSH:
+            push(task[1])
+        elif kind == TO_NAME:
+            name = pop().get_string()
+            if screept.debug_identifiers:
+                print("ID " + repr(task[1]), name)
+            push(name)
+        elif kind == LOOKUP:
+            push(task[1].vars[pop()])
+        elif kind == UNARY:
+            match task[1]:
+                case "-":
+                    push(number(-pop().get_number()))
+                case "!":
+                    push(FALSE if pop().get_number() else TRUE)
+                case op:
+                    raise Exception("Unknown Unary" + op)
+        elif kind == EQUAL:
+            ev_right = pop()
+            push(TRUE if pop() == ev_right else FALSE)
+        elif kind == LESS:
+            ev_right = pop()
+            push(TRUE if pop().get_number() < ev_right.get_number() else FALSE)
+        elif kind == MORE:
+            ev_right = pop()
+            push(TRUE if pop().get_number() > ev_right.get_number() else FALSE)
+        elif kind == CONDITIONAL:
+            _, if_true, if_false, env = task
+            tasks.append((EVAL, if_false if pop() == ZERO else if_true, env))
+        elif kind == CALL_LOOKUP:
+            _, args, env = task
+            func = env.vars[pop()]
+            if not isinstance(func, ValueFunction):
+                raise Exception
+            tasks.append((CALL, func, len(args), env))
+            tasks += [(EVAL, arg, env) for arg in reversed(args)]
+        elif kind == CALL:
+            _, func, count, env = task
+            args = values[len(values) - count:]
+            del values[len(values) - count:]
+            tasks.append((EVAL, func.value, scoped_environment(env, args)))
+        elif kind == PRINT:
+            task[1].output.append(pop().get_string())
+        elif kind == STORE:
+            name = pop()
+            task[1].vars[name] = pop()
+        elif kind == PROC_DEF:
+            task[2].procedures[pop()] = task[1]
+        elif kind == PROC_RUN:
+            _, args, env = task
+            stmt = env.procedures[pop()]
+            tasks.append((EXEC, stmt, env))
+            # `_n` is bound before the next argument is evaluated, like in the tree-walker
+            for n in reversed(range(len(args))):
+                tasks += [(STORE, env), (PUSH, '_' + str(n)), (EVAL, args[n], env)]
+        elif kind == RND:
+            name = pop()
+            max_v = get_numerical_value(pop())
+            min_v = get_numerical_value(pop())
+            task[1].vars[name] = number(task[1].rng.randint(floor(min_v), floor(max_v)))
+        elif kind == IF:
+            _, if_true, if_false, env = task
+            if pop().get_number():
+                tasks.append((EXEC, if_true, env))
+            elif if_false is not None:
+                tasks.append((EXEC, if_false, env))
+        elif kind == EMIT:
+            emit_handler(pop().get_string())
+        else:
+            raise Exception("Unknown task", task)
+    return done
+
+
+class Execution:
+    """A statement or expression running on the explicit stack. It can be suspended between any two tasks, stops
+    with OutOfFuel after `fuel` tasks and with DeadlineExceeded once `timeout` seconds have passed since its first
+    step, so time spent waiting in a Scheduler's queue before that doesn't count. Iterating over it runs it in
+    slices of `slice_steps` tasks:
+
+        for _ in Execution(stmt, env, fuel=100000):
+            ...  # other work between slices
+    """
+
+    def __init__(self, node: Expression | Statement, env: Environment,
+                 emit_handler: Callable[[str], None] = lambda x: None, fuel: Optional[int] = None,
+                 timeout: Optional[float] = None, slice_steps: int = 1000):
+        self.tasks = [(EXEC, node, env) if isinstance(node, Statement) else (EVAL, node, env)]
+        self.values: list[Value] = []
+        self.emit_handler = emit_handler
+        self.fuel = fuel
+        self.timeout = timeout
+        # set by the first step
+        self.deadline: Optional[float] = None
+        self.slice_steps = slice_steps
+        self.steps = 0
+        self.error: Optional[Exception] = None
+
+    @property
+    def finished(self) -> bool:
+        return not self.tasks
+
+    @property
+    def result(self) -> Optional[Value]:
+        """The value of an expression once it has finished"""
+        return self.values[-1] if self.finished and self.values else None
+
+    def step(self, steps: int) -> bool:
+        """Runs up to `steps` tasks, returns True when the execution has finished"""
+        if self.timeout is not None:
+            if self.deadline is None:
+                self.deadline = time.monotonic() + self.timeout
+            elif time.monotonic() > self.deadline:
+                raise DeadlineExceeded(f"deadline passed after {self.steps} steps")
+        if self.fuel is not None:
+            steps = min(steps, self.fuel - self.steps)
+            if steps <= 0 and self.tasks:
+                raise OutOfFuel(f"ran out of fuel after {self.steps} steps")
+        self.steps += _run(self.tasks, self.values, self.emit_handler, steps)
+        return self.finished
+
+    def __iter__(self) -> Iterator["Execution"]:
+        while not self.step(self.slice_steps):
+            yield self
+
+    def run(self) -> Optional[Value]:
+        for _ in self:
+            pass
+        return self.result
+
+
+class Scheduler:
+    """Runs many executions cooperatively, round robin, one slice of each at a time. An execution that raises,
+    runs out of fuel or misses its deadline is dropped with the exception in its `error`; the others go on."""
+
+    def __init__(self):
+        self.queue: deque[Execution] = deque()
+
+    def add(self, execution: Execution) -> Execution:
+        self.queue.append(execution)
+        return execution
+
+    def run_once(self) -> None:
+        execution = self.queue.popleft()
+        try:
+            if not execution.step(execution.slice_steps):
+                self.queue.append(execution)
+        except Exception as e:
+            execution.error = e
+
+    def run(self) -> None:
+        while self.queue:
+            self.run_once()
+
+
+def evaluate_expression(e: Expression, env: Environment) -> Value:
+    """Drop-in replacement for screept.evaluate_expression"""
+    values = []
+    _run([(EVAL, e, env)], values, lambda x: None)
+    return values[-1]
+
+
+def run_statement(s: Statement, env: Environment, emit_handler: Callable[[str], None] = lambda x: None,
+                  fuel: Optional[int] = None, timeout: Optional[float] = None) -> None:
+    """Drop-in replacement for screept.run_statement, optionally limited to `fuel` steps or `timeout` seconds"""
+    if fuel is None and timeout is None:
+        _run([(EXEC, s, env)], [], emit_handler)
+    else:
+        Execution(s, env, emit_handler, fuel, timeout).run()
+
+
+#
+
+
+def deep_expression(depth: int, left: bool = True) -> Expression:
+    """1 + 1 + ... nested `depth` times, to the left like the parser builds it or to the right"""
+    e: Expression = ValueNumber(1)
+    for _ in range(depth):
+        e = ExprBinaryOp(e, "+", ValueNumber(1)) if left else ExprBinaryOp(ValueNumber(1), "+", e)
+    return e
+
+
+def deep_statement(depth: int) -> Statement:
+    s: Statement = StmtBind(IdentifierLiteral("x"), ExprBinaryOp(ExpressionVar(IdentifierLiteral("x")), "+",
+                                                                 ValueNumber(1)))
+    for _ in range(depth):
+        s = StmtIf(ValueNumber(1), StmtBlock([s]))
+    return s
+
+
+def test():
+    import contextlib
+    import io
+    import screept_vm
+    rng = random.Random(0)
+    env = screept_vm.test_environment()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(2000):
+            e = screept_vm.random_expression(rng)
+            assert screept_vm._outcome(evaluate_expression, e, env) == \
+                   screept_vm._outcome(screept.evaluate_expression, e, env), e
+    assert evaluate_expression(deep_expression(100000), env) == ValueNumber(100001)
+    env = Environment({"x": ValueNumber(0)}, {}, [])
+    run_statement(deep_statement(100000), env)
+    assert env.vars["x"] == ValueNumber(1)
+
+    # a procedure running itself forever and a function calling itself forever
+    forever = screept.parse_statement("{ PROC loop { n = n + 1; RUN loop() }; RUN loop() }")
+    env = Environment({"n": ValueNumber(0), "f": ValueFunction(screept.parse_expression("f()"))}, {}, [])
+    try:
+        run_statement(forever, env, fuel=10000)
+    except OutOfFuel:
+        pass
+    else:
+        assert False
+    try:
+        Execution(screept.parse_expression("f()"), env, timeout=0.05).run()
+    except DeadlineExceeded:
+        pass
+    else:
+        assert False
+
+    # the clock starts with the first step, not when the execution is made
+    waiting = Execution(deep_statement(10), Environment({"x": ValueNumber(0)}, {}, []), timeout=0.05)
+    time.sleep(0.1)
+    waiting.run()
+    assert waiting.finished
+
+    scheduler = Scheduler()
+    hog = scheduler.add(Execution(forever, Environment({"n": ValueNumber(0)}, {}, []), fuel=50000, slice_steps=100))
+    players = [scheduler.add(Execution(deep_statement(1000), Environment({"x": ValueNumber(n)}, {}, []),
+                                       slice_steps=100)) for n in range(10)]
+    scheduler.run()
+    assert isinstance(hog.error, OutOfFuel)
+    assert all(p.finished and p.error is None for p in players)
+    print("OK")
+
+
+def benchmark(depth: int = 10000, iterations: int = 20):
+    env = Environment({}, {}, [])
+    old_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(old_limit, depth * 3))
+    try:
+        for left in [True, False]:
+            e = deep_expression(depth, left)
+            timings = []
+            for evaluate in [screept.evaluate_expression, evaluate_expression]:
+                start = time.perf_counter()
+                for _ in range(iterations):
+                    evaluate(e, env)
+                timings.append((time.perf_counter() - start) / iterations)
+            print(f"{depth} deep, nested {'left' if left else 'right'}: recursive {timings[0] * 1000:.2f}ms "
+                  f"iterative {timings[1] * 1000:.2f}ms")
+    finally:
+        sys.setrecursionlimit(old_limit)
+
+
+if __name__ == '__main__':
+    test()
+    benchmark()
@@ -0,0 +1,269 @@
+"""
+Screept function memoization
+================
+
+FUNC values like ``mod`` or ``displayTime`` get called with the same
+arguments many times in a single render. A function is pure when its body,
+and the bodies of the functions it calls, only read its arguments and literal
+vars. Function bodies are expressions, so there is no RND or binding in them.
+Calls to pure functions go through a bounded LRU ``Memo`` keyed by the
+function, its arguments and the stamps (see ``screept.SlotVars``) of every var
+read along the way. Rebinding any of those vars gives it a new stamp, so the
+old entries stop matching and age out of the cache. A var whose slot was never
+written has no stamp to key on, so calls reading it are not memoized.
+
+Only environments backed by ``SlotVars`` can be memoized. Calls anywhere else,
+and calls to functions with computed identifiers (``$[...]``), are evaluated
+as usual and counted as skipped.
+"""
+import time
+from collections import OrderedDict
+from collections.abc import Callable, Sequence
+from dataclasses import dataclass, fields, is_dataclass
+from typing import Optional
+
+from screept import (Expression, Environment, Value, IdentifierLiteral, IdentifierComputed, ExpressionVar,
+                     ValueFunction, ExprFuncCall, Scope, SlotVars, slots, is_argument)
+
+
+@dataclass(slots=True)
+class _Reads:
+    """What a function body uses directly"""
+    vars: set[str]
+    # function name -> fewest arguments it is called with
+    calls: dict[str, int]
+    # 1 + the highest `_n` read
+    arity: int = 0
+
+
+def _direct_reads(node, reads: _Reads) -> bool:
+    """Collects the reads of node, False if it uses a computed identifier"""
+    if isinstance(node, (list, tuple)):
+        return all(_direct_reads(n, reads) for n in node)
+    match node:
+        case IdentifierComputed():
+            return False
+        case ExpressionVar(IdentifierLiteral(name)):
+            if is_argument(name):
+                reads.arity = max(reads.arity, int(name[1:]) + 1)
+            else:
+                reads.vars.add(name)
+            return True
+        case ExprFuncCall(IdentifierLiteral(name), args):
+            reads.calls[name] = min(reads.calls.get(name, len(args)), len(args))
+            return _direct_reads(args, reads)
+        case ValueFunction():
+            # a function value used as a value is not evaluated
+            return True
+    if is_dataclass(node) and not isinstance(node, type):
+        return all(_direct_reads(getattr(node, f.name), reads) for f in fields(node))
+    return True
+
+
+@dataclass(slots=True)
+class _Plan:
+    body: Expression
+    # slots of every var read by the body and the functions it calls, the functions themselves included;
+    # None when the function isn't pure
+    slots: Optional[tuple[int, ...]]
+    arity: int
+    # (slot, stamp) of the called functions the plan was made with
+    functions: tuple[tuple[int, int], ...]
+
+
+def _make_plan(body: Expression, store: SlotVars) -> _Plan:
+    read_slots: set[int] = set()
+    functions: list[tuple[int, int]] = []
+    reads = _Reads(set(), {})
+    pure = _direct_reads(body, reads)
+    arity = reads.arity
+    pending = [reads]
+    seen = {id(body)}
+    while pure and pending:
+        reads = pending.pop()
+        for name in reads.vars:
+            slot = slots.slots.get(name)
+            if slot is None:
+                # kept in SlotVars.extra, which has no stamps
+                pure = False
+                break
+            read_slots.add(slot)
+        for name, args in reads.calls.items():
+            slot = slots.slots.get(name)
+            if slot is None or slot >= len(store.slot_values):
+                pure = False
+                break
+            func = store.slot_values[slot]
+            if not isinstance(func, ValueFunction):
+                pure = False
+                break
+            read_slots.add(slot)
+            functions.append((slot, store.stamps[slot]))
+            if id(func.value) in seen:
+                continue
+            seen.add(id(func.value))
+            callee = _Reads(set(), {})
+            # `_n` past the arguments given would be read from the caller's frame
+            if not _direct_reads(func.value, callee) or callee.arity > args:
+                pure = False
+                break
+            pending.append(callee)
+    return _Plan(body, tuple(sorted(read_slots)) if pure else None, arity, tuple(functions))
+
+
+def _argument_key(v: Value):
+    x = v.value
+    # 1 == 1.0 and 0.0 == -0.0 but they print differently
+    return x if x.__class__ is not float else (x.hex(),)
+
+
+class Memo:
+    def __init__(self, max_size: int = 4096):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+        self._entries: OrderedDict[tuple, Value] = OrderedDict()
+        # id(body) -> plan, which keeps the body alive so its id can't be reused
+        self._plans: dict[int, _Plan] = {}
+
+    @property
+    def hit_rate(self) -> float:
+        calls = self.hits + self.misses
+        return self.hits / calls if calls else 0.0
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._plans.clear()
+
+    def stats(self) -> dict[str, float]:
+        return {"hits": self.hits, "misses": self.misses, "skipped": self.skipped, "hit_rate": self.hit_rate,
+                "entries": len(self._entries)}
+
+    def _key(self, body: Expression, values: Sequence[Value], env: Environment) -> Optional[tuple]:
+        store = env.vars
+        if store.__class__ is Scope:
+            store = store.parent
+        if store.__class__ is not SlotVars:
+            return None
+        plan = self._plans.get(id(body))
+        stamps = store.stamps
+        if plan is None or any(slot >= len(stamps) or stamps[slot] != stamp for slot, stamp in plan.functions):
+            if len(self._plans) >= self.max_size:
+                # entries are keyed by id(body), so they go together with the plans keeping the bodies alive
+                self.clear()
+            plan = self._plans[id(body)] = _make_plan(body, store)
+        if plan.slots is None or len(values) < plan.arity:
+            return None
+        if any(v.__class__ is ValueFunction for v in values):
+            # their bodies can't be hashed
+            return None
+        try:
+            read = [stamps[slot] for slot in plan.slots]
+        except IndexError:
+            # a var never written, the call raises
+            return None
+        if 0 in read:
+            # never written through its slot: unbound, or its value is still in SlotVars.extra, which has no stamps
+            return None
+        return id(body), len(values), *map(_argument_key, values), *read
+
+    def call(self, func: ValueFunction, values: Sequence[Value], env: Environment,
+             evaluate: Callable[[Expression, Sequence[Value], Environment], Value]) -> Value:
+        """evaluate(func.value, values, env), from the cache if func is pure and was called like this before"""
+        body = func.value
+        key = self._key(body, values, env)
+        if key is None:
+            self.skipped += 1
+            return evaluate(body, values, env)
+        entries = self._entries
+        result = entries.get(key)
+        if result is not None:
+            self.hits += 1
+            entries.move_to_end(key)
+            return result
+        self.misses += 1
+        # errors are not cached, the call raises again next time
+        result = evaluate(body, values, env)
+        entries[key] = result
+        if len(entries) > self.max_size:
+            entries.popitem(last=False)
+        return result
+
+
+#
+
+
+def test():
+    import screept
+    import screept_compiler
+    from screept import parse_expression, parse_statement, number
+    memo = Memo()
+    previous, screept_compiler.memo = screept_compiler.memo, memo
+    try:
+        variables = {
+            'mod': ValueFunction(parse_expression("_0 - (_0 // _1) * _1")),
+            'clock': ValueFunction(parse_expression('"" + mod(time, 60) + ":" + _0')),
+            'pick': ValueFunction(parse_expression('$["v" + _0]')),
+            'outer': ValueFunction(parse_expression('inner(1)')),
+            'inner': ValueFunction(parse_expression('_0 + _1')),
+            'time': number(125), 'v1.0': number(7)}
+        # names get their slots before the store is filled, like in dialogs.load_game_data
+        screept.resolve_names([IdentifierLiteral(name) for name in variables] + list(variables.values()))
+        env = Environment(SlotVars(variables), {}, [])
+        for source, expected in [("mod(7, 3)", number(1.0)), ("mod(7, 3)", number(1.0)),
+                                 ("clock(1)", screept.ValueString("5.0:1.0")), ("pick(1)", number(7))]:
+            assert screept_compiler.evaluate_expression(parse_expression(source), env) == expected, source
+        assert memo.hits == 1 and memo.skipped == 1
+        # the parser only makes floats, ints must not share their entries
+        call = ExprFuncCall(IdentifierLiteral('mod'), [number(7), number(3)])
+        assert repr(screept_compiler.evaluate_expression(call, env)) == repr(number(1))
+        # rebinding a var the function reads makes the old entry miss
+        misses = memo.misses
+        screept_compiler.run_statement(parse_statement("time = 61"), env)
+        assert screept_compiler.evaluate_expression(parse_expression("clock(1)"), env) == screept.ValueString("1.0:1.0")
+        assert memo.misses == misses + 2
+        # so does rebinding a function it calls
+        screept_compiler.run_statement(parse_statement('mod = FUNC _0 + _1'), env)
+        clock = screept_compiler.evaluate_expression(parse_expression("clock(1)"), env)
+        assert clock == screept.ValueString("121.0:1.0")
+        # inner reads a `_1` that outer doesn't pass, so it depends on the caller
+        assert screept_compiler.evaluate_expression(parse_expression("outer(0, 5)"), env) == number(6.0)
+        assert screept_compiler.evaluate_expression(parse_expression("outer(0, 6)"), env) == number(7.0)
+        # a var written through $[...] before it had a slot stays in SlotVars.extra, its slot never stamped,
+        # so two environments with different values would share a key
+        late = [Environment(SlotVars(), {}, []) for _ in range(2)]
+        for e, v in zip(late, (1, 100)):
+            screept_compiler.run_statement(parse_statement(f'$["memoLate"] = {v}'), e)
+        late_function = ValueFunction(parse_expression("_0 + memoLate"))
+        screept.resolve_names([IdentifierLiteral('memoLate'), IdentifierLiteral('memoLateF'), late_function])
+        for e, expected in zip(late, (2.0, 101.0)):
+            e.vars['memoLateF'] = late_function
+            assert screept_compiler.evaluate_expression(parse_expression("memoLateF(1)"), e) == number(expected)
+    finally:
+        screept_compiler.memo = previous
+    print(memo.stats())
+    print("OK")
+
+
+def benchmark(iterations: int = 2000):
+    import dialogs
+    import screept
+    import screept_compiler
+    game = dialogs.load_game("customGame")
+    env = game.game_state.environment
+    status_line = screept.parse_expression('__statusLine()')
+    previous = screept_compiler.memo
+    for name, memo in [("no memo", None), ("memo", Memo())]:
+        screept_compiler.memo = memo
+        start = time.perf_counter()
+        for _ in range(iterations):
+            screept_compiler.evaluate_expression(status_line, env)
+        elapsed = time.perf_counter() - start
+        print(f"{name:>8}: {elapsed / iterations * 1e6:.1f}us per status line", memo.stats() if memo else "")
+    screept_compiler.memo = previous
+
+
+if __name__ == '__main__':
+    test()
+    benchmark()
@@ -0,0 +1,156 @@
+"""
+Screept optimizer
+================
+
+AST to AST pass run once at load time: folds constant subexpressions, drops
+dead branches of ``ExprConditional``/``StmtIf`` with literal conditions and
+flattens nested ``StmtBlock``. The result evaluates exactly like the input.
+"""
+from dataclasses import fields, is_dataclass
+
+from screept import (Expression, Statement, Environment, Identifier, Value, IdentifierLiteral, IdentifierComputed,
+                     ExpressionVar, ValueNumber, ValueString, ValueFunction, ExprFuncCall, ExprBinaryOp, ExprUnaryOP,
+                     ExprConditional, ExprComparisonEqual, ExprComparisonLess, ExprComparisonMore, StmtPrint,
+                     StmtBlock, StmtBind, StmtProcDef, StmtProcRun, StmtRnd, StmtIf, StmtEmit, evaluate_expression,
+                     ZERO)
+
+
+def count_nodes(node) -> int:
+    if isinstance(node, (list, tuple)):
+        return sum(map(count_nodes, node))
+    if not isinstance(node, (Expression, Statement, Identifier)):
+        return 0
+    return 1 + sum(count_nodes(getattr(node, f.name)) for f in fields(node)) if is_dataclass(node) else 1
+
+
+def _fold(e: Expression) -> Expression:
+    # Only literals are involved, so an empty environment is enough. Anything that raises stays as it is
+    # and raises at run time, like before.
+    try:
+        return evaluate_expression(e, Environment({}, {}, []))
+    except Exception:
+        return e
+
+
+class Optimizer:
+    """Keeps count of the nodes removed by all the expressions and statements it optimized"""
+
+    def __init__(self):
+        self.removed = 0
+
+    def expression(self, e: Expression) -> Expression:
+        result = self._expression(e)
+        self.removed += count_nodes(e) - count_nodes(result)
+        return result
+
+    def statement(self, s: Statement) -> Statement:
+        result = self._statement(s)
+        self.removed += count_nodes(s) - count_nodes(result)
+        return result
+
+    def value(self, v: Value) -> Value:
+        match v:
+            case ValueFunction(body):
+                return ValueFunction(self.expression(body))
+            case _:
+                return v
+
+    def _identifier(self, i: Identifier) -> Identifier:
+        match i:
+            case IdentifierComputed(x):
+                x = self._expression(x)
+                if isinstance(x, (ValueNumber, ValueString)):
+                    return IdentifierLiteral(x.get_string())
+                return IdentifierComputed(x)
+            case _:
+                return i
+
+    def _expression(self, e: Expression) -> Expression:
+        match e:
+            case ValueFunction(body):
+                return ValueFunction(self._expression(body))
+            case ExprBinaryOp(left, op, right):
+                left = self._expression(left)
+                right = self._expression(right)
+                if isinstance(left, Value) and isinstance(right, Value):
+                    return _fold(ExprBinaryOp(left, op, right))
+                # (x + "a") + "b" is a string whatever x is, so it is the same as x + "ab"
+                if op == "+" and isinstance(right, (ValueString, ValueNumber)):
+                    match left:
+                        case ExprBinaryOp(inner, "+", ValueString(s)):
+                            return ExprBinaryOp(inner, "+", ValueString(s + right.get_string()))
+                return ExprBinaryOp(left, op, right)
+            case ExpressionVar(i):
+                return ExpressionVar(self._identifier(i))
+            case ExprUnaryOP(left, op):
+                left = self._expression(left)
+                if isinstance(left, Value):
+                    return _fold(ExprUnaryOP(left, op))
+                return ExprUnaryOP(left, op)
+            case ExprFuncCall(i, args):
+                return ExprFuncCall(self._identifier(i), [self._expression(arg) for arg in args])
+            case ExprComparisonEqual(left, right) | ExprComparisonLess(left, right) | ExprComparisonMore(left, right):
+                folded = type(e)(self._expression(left), self._expression(right))
+                if isinstance(folded.left, Value) and isinstance(folded.right, Value):
+                    return _fold(folded)
+                return folded
+            case ExprConditional(cond, if_true, if_false):
+                cond = self._expression(cond)
+                if isinstance(cond, Value):
+                    # same test as the tree-walker: only the number 0 is false
+                    return self._expression(if_false if cond == ZERO else if_true)
+                return ExprConditional(cond, self._expression(if_true), self._expression(if_false))
+            case _:
+                return e
+
+    def _statement(self, s: Statement) -> Statement:
+        match s:
+            case StmtPrint(e):
+                return StmtPrint(self._expression(e))
+            case StmtBind(i, e):
+                return StmtBind(self._identifier(i), self._expression(e))
+            case StmtBlock(ss):
+                statements = []
+                for st in map(self._statement, ss):
+                    if isinstance(st, StmtBlock):
+                        statements.extend(st.statements)
+                    else:
+                        statements.append(st)
+                return StmtBlock(statements)
+            case StmtProcDef(i, stmt):
+                return StmtProcDef(self._identifier(i), self._statement(stmt))
+            case StmtProcRun(i, args):
+                return StmtProcRun(self._identifier(i), [self._expression(arg) for arg in args])
+            case StmtRnd(i, min_val, max_val):
+                return StmtRnd(self._identifier(i), self._expression(min_val), self._expression(max_val))
+            case StmtIf(cond, if_true, if_false):
+                cond = self._expression(cond)
+                if isinstance(cond, Value):
+                    if cond.get_number():
+                        return self._statement(if_true)
+                    return StmtBlock([]) if if_false is None else self._statement(if_false)
+                return StmtIf(cond, self._statement(if_true), None if if_false is None else self._statement(if_false))
+            case StmtEmit(e):
+                return StmtEmit(self._expression(e))
+            case _:
+                return s
+
+
+def test():
+    from screept import parse_expression, parse_statement
+    optimizer = Optimizer()
+    assert optimizer.expression(parse_expression('"a" + "b" + x + "c" + 1 + "d"')) == \
+           ExprBinaryOp(ExprBinaryOp(ValueString("ab"), "+", ExpressionVar(IdentifierLiteral("x"))), "+",
+                        ValueString("c1.0d"))
+    assert optimizer.expression(parse_expression('(2 > 1) ? x : y')) == ExpressionVar(IdentifierLiteral("x"))
+    assert optimizer.expression(parse_expression('1 / 0')) == ExprBinaryOp(ValueNumber(1), "/", ValueNumber(0))
+    assert optimizer.statement(parse_statement('{ {a = 1; IF 0 THEN b = 2 ELSE {c = 3}}; $["d"] = 4 }')) == \
+           StmtBlock([StmtBind(IdentifierLiteral("a"), ValueNumber(1)),
+                      StmtBind(IdentifierLiteral("c"), ValueNumber(3)),
+                      StmtBind(IdentifierLiteral("d"), ValueNumber(4))])
+    print("removed", optimizer.removed, "nodes")
+    print("OK")
+
+
+if __name__ == '__main__':
+    test()
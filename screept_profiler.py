@@ -0,0 +1,161 @@
+"""
+Screept profiler
+================
+
+Opt-in profiling of Screept, on the tree-walker in ``screept`` and on the
+compiled closures of ``screept_compiler``, which is what ``dialogs`` runs.
+While a ``Profiler`` is active every procedure (``StmtProcRun``) and function
+(``ExprFuncCall``) call goes through it, and it records per procedure and
+function the call count and cumulative and self time. The tree-walker also
+reports the number of nodes evaluated; compiled code has no nodes left to
+count. Stacks can be written in the collapsed format read by flamegraph.pl
+and speedscope.
+
+    with Profiler() as profiler:
+        dialogs.run_statement(stmt, env)
+    profiler.report()
+    profiler.write_collapsed("screept.collapsed")
+"""
+import time
+from collections import Counter
+from collections.abc import Callable
+from dataclasses import dataclass
+
+import screept
+from screept import Environment, Identifier, IdentifierLiteral
+
+
+@dataclass
+class CallStats:
+    calls: int = 0
+    cumulative: float = 0.0
+    self_time: float = 0.0
+    nodes: int = 0
+
+
+@dataclass
+class _Frame:
+    name: str
+    start: float
+    children: float = 0.0
+    nodes: int = 0
+
+
+def _name(kind: str, i: Identifier) -> str:
+    match i:
+        case IdentifierLiteral(x):
+            return kind + " " + x
+        case _:
+            return kind + " <computed>"
+
+
+class Profiler:
+    def __init__(self):
+        self.stats: dict[str, CallStats] = {}
+        # "screept;proc passTurn;func mod" -> self time in seconds
+        self.collapsed: Counter[str] = Counter()
+        self._stack: list[_Frame] = []
+
+    def __enter__(self) -> "Profiler":
+        self._stack = [_Frame("screept", time.perf_counter())]
+        screept.set_profiler(self)
+        return self
+
+    def __exit__(self, *_) -> None:
+        screept.set_profiler(None)
+        self._exit()
+
+    def _enter(self, name: str) -> None:
+        self._stack.append(_Frame(name, time.perf_counter()))
+
+    def _exit(self) -> None:
+        frame = self._stack[-1]
+        elapsed = time.perf_counter() - frame.start
+        self_time = elapsed - frame.children
+        stats = self.stats.setdefault(frame.name, CallStats())
+        stats.calls += 1
+        stats.self_time += self_time
+        stats.nodes += frame.nodes
+        self.collapsed[";".join(f.name for f in self._stack)] += self_time
+        self._stack.pop()
+        # recursive calls are already inside the cumulative time of the outermost one
+        if all(f.name != frame.name for f in self._stack):
+            stats.cumulative += elapsed
+        if self._stack:
+            self._stack[-1].children += elapsed
+
+    def node(self) -> None:
+        """Called by the tree-walker for every node it evaluates"""
+        self._stack[-1].nodes += 1
+
+    def call(self, kind: str, identifier: Identifier, run: Callable, *args):
+        """Called by both backends for every function ("func") and procedure ("proc") call, with what runs it.
+        The arguments are evaluated inside the call, so they are counted in it."""
+        self._enter(_name(kind, identifier))
+        try:
+            return run(*args)
+        finally:
+            self._exit()
+
+    def report(self) -> None:
+        print(f"{'name':<30}{'calls':>8}{'cumulative ms':>15}{'self ms':>10}{'nodes':>10}")
+        for name, stats in sorted(self.stats.items(), key=lambda x: -x[1].cumulative):
+            print(f"{name:<30}{stats.calls:>8}{stats.cumulative * 1000:>15.3f}{stats.self_time * 1000:>10.3f}"
+                  f"{stats.nodes:>10}")
+
+    def write_collapsed(self, path: str) -> None:
+        """One `frame;frame;frame weight` line per stack, weight being self time in microseconds"""
+        with open(path, "w") as f:
+            for stack, seconds in sorted(self.collapsed.items()):
+                f.write(f"{stack} {round(seconds * 1e6)}\n")
+
+
+def profile_game(title: str, path: str = "screept.collapsed") -> Profiler:
+    """Runs every screept action of the game once and renders the status line, on copies of the environment and
+    on the backend dialogs uses"""
+    from copy import deepcopy
+    import dialogs
+    game = dialogs.load_game(title)
+    env = game.game_state.environment
+    with Profiler() as profiler:
+        for dialog in game.dialogs.values():
+            for option in dialog.options:
+                for action in option.actions:
+                    if isinstance(action, dialogs.DAScreept):
+                        dialogs.run_statement(action.value, deepcopy(env))
+            if '__statusLine' in env.vars:
+                dialogs.evaluate_expression(screept.parse_expression('__statusLine()'), env)
+    profiler.report()
+    profiler.write_collapsed(path)
+    return profiler
+
+
+def test():
+    import screept_compiler
+    from screept import evaluate_expression
+    stmt = screept.parse_statement("{ PROC p { x = f(_0) }; RUN p(3) }")
+    for run in [screept.run_statement, screept_compiler.run_statement]:
+        env = Environment({'f': screept.ValueFunction(screept.parse_expression("_0 > 0 ? _0 + f(_0 - 1) : 0"))},
+                          {}, [])
+        memo, screept_compiler.memo = screept_compiler.memo, None
+        try:
+            with Profiler() as profiler:
+                run(stmt, env)
+                # a call at the top, through a name imported before the profiler started
+                evaluate_expression(screept.parse_expression("f(1)"), env)
+        finally:
+            screept_compiler.memo = memo
+        assert env.vars['x'] == screept.number(6.0)
+        assert profiler.stats["proc p"].calls == 1
+        assert profiler.stats["func f"].calls == 6
+        assert profiler.collapsed["screept;proc p;func f"] <= profiler.stats["proc p"].cumulative
+        assert (profiler.stats["proc p"].nodes > 0) == (run is screept.run_statement)
+        assert "screept;proc p;func f;func f;func f;func f" in profiler.collapsed
+        assert "screept;func f;func f" in profiler.collapsed
+    assert screept.profiler is None
+    print("OK")
+
+
+if __name__ == '__main__':
+    test()
+    profile_game("customGame")
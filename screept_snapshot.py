@@ -0,0 +1,143 @@
+"""
+Screept snapshots
+================
+
+Saves a ``screept.Environment`` (vars, procedures, output) to a compact binary
+blob and loads it back, for saving and forking game state without
+``deepcopy`` or the JSON schema read by ``dialogs.load_game``.
+
+A snapshot is a fixed header (magic, format version, flags) followed by the
+environment pickled with the highest protocol, zlib compressed when the
+COMPRESSED flag is set. Loading only accepts the ``screept`` classes an
+environment is made of (``allowed``), so a tampered save file can't make the
+unpickler call anything else, not even ``FileSink``.
+"""
+import io
+import json
+import pickle
+import struct
+import time
+import zlib
+
+import screept
+from screept import Environment
+
+# values and the ASTs of functions and procedures
+syntax_classes = (
+    screept.ValueNumber, screept.ValueString, screept.ValueFunction, screept.IdentifierLiteral,
+    screept.IdentifierComputed, screept.ExpressionVar, screept.ExprFuncCall, screept.ExprBinaryOp,
+    screept.ExprUnaryOP, screept.ExprConditional, screept.ExprComparisonEqual, screept.ExprComparisonLess,
+    screept.ExprComparisonMore, screept.StmtPrint, screept.StmtBlock, screept.StmtBind, screept.StmtProcDef,
+    screept.StmtProcRun, screept.StmtRnd, screept.StmtIf, screept.StmtEmit)
+
+# name -> class of everything a snapshot may hold; of the sinks only those keeping lines in memory
+allowed = {cls.__name__: cls for cls in syntax_classes + (
+    Environment, screept.SlotVars, screept.Scope, screept.Rng, screept.NullSink, screept.RingBufferSink)}
+
+MAGIC = b"SCRPT"
+VERSION = 1
+COMPRESSED = 1
+
+_header = struct.Struct("<5sHB")
+
+
+class _Unpickler(pickle.Unpickler):
+    def find_class(self, module: str, name: str):
+        if module == "screept" and name in allowed:
+            return allowed[name]
+        raise pickle.UnpicklingError(f"{module}.{name} is not allowed in a snapshot")
+
+
+def dumps(env: Environment, compress: bool = True) -> bytes:
+    body = pickle.dumps(env, protocol=pickle.HIGHEST_PROTOCOL)
+    if compress:
+        body = zlib.compress(body, 1)
+    return _header.pack(MAGIC, VERSION, COMPRESSED if compress else 0) + body
+
+
+def loads(data: bytes) -> Environment:
+    magic, version, flags = _header.unpack_from(data)
+    if magic != MAGIC:
+        raise Exception("Not a Screept snapshot")
+    if version != VERSION:
+        raise Exception(f"Unsupported snapshot version {version}, expected {VERSION}")
+    body = memoryview(data)[_header.size:]
+    if flags & COMPRESSED:
+        body = zlib.decompress(body)
+    env = _Unpickler(io.BytesIO(body)).load()
+    if not isinstance(env, Environment):
+        raise Exception("Snapshot does not hold an Environment")
+    return env
+
+
+def save(env: Environment, path: str, compress: bool = True) -> None:
+    with open(path, "wb") as f:
+        f.write(dumps(env, compress))
+
+
+def load(path: str) -> Environment:
+    with open(path, "rb") as f:
+        return loads(f.read())
+
+
+#
+
+
+def _load_json_env(text: str) -> Environment:
+    import dialogs
+    env = json.loads(text)['gameState']['screeptEnv']
+    variables = dict(map(dialogs.process_var, env['vars'].items()))
+    procedures = dict(map(dialogs.process_procedure, env['procedures'].items()))
+    return Environment(screept.SlotVars(variables), procedures, list(env['output']))
+
+
+def test():
+    import dialogs
+    for title in ["customGame", "fable"]:
+        env = dialogs.load_game(title).game_state.environment
+        env.output.append("line")
+        for compress in [True, False]:
+            assert loads(dumps(env, compress)) == env
+
+    class Evil:
+        def __reduce__(self):
+            return print, ("should not be called",)
+
+    # a function, a class screept only imports and one it defines that opens files
+    for body in [pickle.dumps(Evil()), b"cscreept\nLark\n.", b"cscreept\nFileSink\n."]:
+        try:
+            loads(_header.pack(MAGIC, VERSION, 0) + body)
+        except pickle.UnpicklingError:
+            pass
+        else:
+            assert False
+    print("OK")
+
+
+def benchmark(iterations: int = 50):
+    for title in ["customGame", "fable"]:
+        with open("data/" + title + ".json") as f:
+            text = f.read()
+        env = _load_json_env(text)
+        env_json = json.dumps(json.loads(text)['gameState']['screeptEnv'], separators=(",", ":"))
+        snapshot = dumps(env)
+
+        start = time.perf_counter()
+        for _ in range(iterations):
+            _load_json_env(text)
+        json_time = (time.perf_counter() - start) / iterations
+        start = time.perf_counter()
+        for _ in range(iterations):
+            dumps(env)
+        save_time = (time.perf_counter() - start) / iterations
+        start = time.perf_counter()
+        for _ in range(iterations):
+            loads(snapshot)
+        load_time = (time.perf_counter() - start) / iterations
+        print(f"{title}: JSON env {len(env_json)} bytes, load {json_time * 1000:.2f}ms | "
+              f"snapshot {len(snapshot)} bytes, save {save_time * 1000:.2f}ms, load {load_time * 1000:.2f}ms")
+
+
+if __name__ == '__main__':
+    test()
+    benchmark()
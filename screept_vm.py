@@ -0,0 +1,541 @@
+"""
+Screept VM
+================
+
+Stack based bytecode for Screept. Expressions and statements compile to a flat
+``array`` of ``(opcode, argument)`` pairs and a constant pool. Literal
+identifiers are referred to by their slot in ``screept.slots``, so on
+``SlotVars`` a LOAD or STORE is a list index. Function and procedure bodies
+compile to nested programs and no AST is kept, so a compiled program is much
+smaller than the ``@dataclass`` tree it came from. FUNC values and procedures
+defined by VM code hold those programs and only run on the VM.
+"""
+import random
+import time
+import tracemalloc
+import weakref
+from array import array
+from collections.abc import Callable
+from copy import deepcopy
+from dataclasses import dataclass
+from math import floor
+from operator import sub, mul, truediv, floordiv
+
+import screept
+from screept import (Expression, Statement, Environment, Identifier, Value, IdentifierLiteral, IdentifierComputed,
+                     ExpressionVar, ValueNumber, ValueString, ValueFunction, ExprFuncCall, ExprBinaryOp, ExprUnaryOP,
+                     ExprConditional, ExprComparisonEqual, ExprComparisonLess, ExprComparisonMore, StmtPrint,
+                     StmtBlock, StmtBind, StmtProcDef, StmtProcRun, StmtRnd, StmtIf, StmtEmit, get_numerical_value,
+                     scoped_environment, number, TRUE, FALSE, SlotVars, slots, UNBOUND)
+
+# opcodes, the argument of each is described next to it
+CONST = 0  # push constants[arg]
+LOAD = 1  # push vars[slots.names[arg]], arg is the name's slot
+LOAD_NAME = 2  # pop name, push vars[name]
+STORE = 3  # pop value, vars[slots.names[arg]] = value
+STORE_NAME = 4  # pop name, pop value, vars[name] = value
+NAME = 5  # push names[arg]
+TO_NAME = 6  # pop value, push its string; constants[arg] is the repr of the IdentifierComputed
+ADD = 7
+SUB = 8
+MUL = 9
+DIV = 10
+FLOORDIV = 11
+NEG = 12
+NOT = 13
+EQ = 14
+LT = 15
+GT = 16
+JUMP = 17  # jump to arg
+JUMP_IF_ZERO = 18  # pop, jump to arg if it is ValueNumber 0 (ExprConditional)
+JUMP_IF_FALSE = 19  # pop, jump to arg if its number is falsy (StmtIf)
+CHECK_FUNC = 20  # raise unless top of the stack is a ValueFunction
+CALL = 21  # pop arg values and the function, push the result
+PRINT = 22
+EMIT = 23
+PROC_DEF = 24  # pop name, procedures[name] = constants[arg], a Program
+PROC_LOOKUP = 25  # pop name, push procedures[name]
+PROC_CALL = 26  # pop procedure and run it
+RND = 27  # pop name, max, min
+RAISE = 28  # raise constants[arg]
+
+opcode_names = ["CONST", "LOAD", "LOAD_NAME", "STORE", "STORE_NAME", "NAME", "TO_NAME", "ADD", "SUB", "MUL", "DIV",
+                "FLOORDIV", "NEG", "NOT", "EQ", "LT", "GT", "JUMP", "JUMP_IF_ZERO", "JUMP_IF_FALSE", "CHECK_FUNC",
+                "CALL", "PRINT", "EMIT", "PROC_DEF", "PROC_LOOKUP", "PROC_CALL", "RND", "RAISE"]
+
+_binary_opcodes = {"+": ADD, "-": SUB, "*": MUL, "/": DIV, "//": FLOORDIV}
+
+
+@dataclass(slots=True)
+class Program:
+    code: array
+    constants: list
+    # names pushed by NAME: the arguments `_0.._n`, which have no slot, and identifiers of PROC and RND
+    names: list[str]
+
+
+class _Assembler:
+    def __init__(self):
+        self.code = array('i')
+        self.constants = []
+        self.names: list[str] = []
+        self.slots: dict[str, int] = {}
+
+    def emit(self, op: int, arg: int = 0) -> int:
+        self.code.append(op)
+        self.code.append(arg)
+        return len(self.code) - 2
+
+    def patch(self, at: int) -> None:
+        self.code[at + 1] = len(self.code)
+
+    def constant(self, value) -> int:
+        self.constants.append(value)
+        return len(self.constants) - 1
+
+    def slot(self, name: str) -> int:
+        """Index of the name in this program's names"""
+        if name not in self.slots:
+            self.slots[name] = len(self.names)
+            self.names.append(name)
+        return self.slots[name]
+
+    def load(self, name: str) -> None:
+        slot = slots.slot(name)
+        if slot is None:
+            self.emit(NAME, self.slot(name))
+            self.emit(LOAD_NAME)
+        else:
+            self.emit(LOAD, slot)
+
+    def store(self, name: str) -> None:
+        slot = slots.slot(name)
+        if slot is None:
+            self.emit(NAME, self.slot(name))
+            self.emit(STORE_NAME)
+        else:
+            self.emit(STORE, slot)
+
+    def program(self) -> Program:
+        return Program(self.code, self.constants, self.names)
+
+    def name(self, i: Identifier) -> None:
+        match i:
+            case IdentifierLiteral(x):
+                self.emit(NAME, self.slot(x))
+            case IdentifierComputed(x):
+                self.expression(x)
+                self.emit(TO_NAME, self.constant(repr(i)))
+            case _:
+                self.emit(RAISE, self.constant(Exception("Wrong identifier" + repr(i))))
+
+    def expression(self, e: Expression) -> None:
+        match e:
+            case ValueNumber() | ValueString():
+                self.emit(CONST, self.constant(e))
+            case ValueFunction(body):
+                self.emit(CONST, self.constant(ValueFunction(_program(body))))
+            case ExprBinaryOp(left, op, right):
+                self.expression(left)
+                self.expression(right)
+                if op in _binary_opcodes:
+                    self.emit(_binary_opcodes[op])
+                else:
+                    self.emit(RAISE, self.constant(Exception("Unknown binary: " + op)))
+            case ExpressionVar(IdentifierLiteral(x)):
+                self.load(x)
+            case ExpressionVar(i):
+                self.name(i)
+                self.emit(LOAD_NAME)
+            case ExprUnaryOP(left, op):
+                self.expression(left)
+                match op:
+                    case "-":
+                        self.emit(NEG)
+                    case "!":
+                        self.emit(NOT)
+                    case _:
+                        self.emit(RAISE, self.constant(Exception("Unknown Unary" + op)))
+            case ExprFuncCall(i, args):
+                self.expression(ExpressionVar(i))
+                self.emit(CHECK_FUNC)
+                for arg in args:
+                    self.expression(arg)
+                self.emit(CALL, len(args))
+            case ExprComparisonEqual(left, right):
+                self.expression(left)
+                self.expression(right)
+                self.emit(EQ)
+            case ExprComparisonLess(left, right):
+                self.expression(left)
+                self.expression(right)
+                self.emit(LT)
+            case ExprComparisonMore(left, right):
+                self.expression(left)
+                self.expression(right)
+                self.emit(GT)
+            case ExprConditional(cond, if_true, if_false):
+                self.expression(cond)
+                to_false = self.emit(JUMP_IF_ZERO)
+                self.expression(if_true)
+                to_end = self.emit(JUMP)
+                self.patch(to_false)
+                self.expression(if_false)
+                self.patch(to_end)
+            case _:
+                self.emit(RAISE, self.constant(Exception("Can't handle EXPR ", e)))
+
+    def statement(self, s: Statement) -> None:
+        match s:
+            case StmtPrint(e):
+                self.expression(e)
+                self.emit(PRINT)
+            case StmtBind(IdentifierLiteral(x), e):
+                self.expression(e)
+                self.store(x)
+            case StmtBind(i, e):
+                self.expression(e)
+                self.name(i)
+                self.emit(STORE_NAME)
+            case StmtBlock(ss):
+                for st in ss:
+                    self.statement(st)
+            case StmtProcDef(i, stmt):
+                self.name(i)
+                self.emit(PROC_DEF, self.constant(compile_statement(stmt)))
+            case StmtProcRun(i, args):
+                self.name(i)
+                self.emit(PROC_LOOKUP)
+                # each `_n` is bound before the next argument is evaluated, like in the tree-walker
+                for n, arg in enumerate(args):
+                    self.expression(arg)
+                    self.store('_' + str(n))
+                self.emit(PROC_CALL)
+            case StmtRnd(i, min_val, max_val):
+                self.expression(min_val)
+                self.expression(max_val)
+                self.name(i)
+                self.emit(RND)
+            case StmtIf(cond, if_true, if_false):
+                self.expression(cond)
+                to_false = self.emit(JUMP_IF_FALSE)
+                self.statement(if_true)
+                if if_false is None:
+                    self.patch(to_false)
+                else:
+                    to_end = self.emit(JUMP)
+                    self.patch(to_false)
+                    self.statement(if_false)
+                    self.patch(to_end)
+            case StmtEmit(e):
+                self.expression(e)
+                self.emit(EMIT)
+            case _:
+                self.emit(RAISE, self.constant(Exception("unknown statement", s)))
+
+
+def compile_expression(e: Expression) -> Program:
+    assembler = _Assembler()
+    assembler.expression(e)
+    return assembler.program()
+
+
+def compile_statement(s: Statement) -> Program:
+    assembler = _Assembler()
+    assembler.statement(s)
+    return assembler.program()
+
+
+# id(node) -> (weak reference to the node, program). An entry goes when its node does, before the id can be reused.
+_programs: dict[int, tuple[weakref.ref, Program]] = {}
+
+
+def compile_cached(node: Expression | Statement) -> Program:
+    key = id(node)
+    hit = _programs.get(key)
+    if hit is not None:
+        return hit[1]
+    program = compile_statement(node) if isinstance(node, Statement) else compile_expression(node)
+    try:
+        ref = weakref.ref(node, lambda _: _programs.pop(key, None))
+    except TypeError:
+        # values are slotted, they compile to a single CONST anyway
+        return program
+    _programs[key] = (ref, program)
+    return program
+
+
+def _program(body: Expression | Statement | Program) -> Program:
+    """The program of a function or procedure body, which is an AST unless VM code defined it"""
+    return body if body.__class__ is Program else compile_cached(body)
+
+
+def execute(program: Program, env: Environment, emit_handler: Callable[[str], None] = lambda x: None) -> Value | None:
+    """Runs the program and returns the top of the stack, which is the value of a compiled expression"""
+    code = program.code
+    constants = program.constants
+    names = program.names
+    env_vars = env.vars
+    slot_names = slots.names
+    slot_values = env_vars.slot_values if env_vars.__class__ is SlotVars else None
+    stack = []
+    push = stack.append
+    pop = stack.pop
+    pc = 0
+    end = len(code)
+    while pc < end:
+        op = code[pc]
+        arg = code[pc + 1]
+        pc += 2
+        if op == LOAD:
+            if slot_values is not None and arg < len(slot_values):
+                v = slot_values[arg]
+                # unbound names go through the mapping, which raises the KeyError
+                push(v if v is not UNBOUND else env_vars[slot_names[arg]])
+            else:
+                push(env_vars[slot_names[arg]])
+        elif op == CONST:
+            push(constants[arg])
+        elif op == ADD:
+            rr = pop()
+            ll = pop()
+            if ll.__class__ is ValueNumber and rr.__class__ is ValueNumber:
+                push(number(ll.value + rr.value))
+            else:
+                push(ValueString(ll.get_string() + rr.get_string()))
+        elif op == STORE:
+            if slot_values is not None:
+                env_vars.set_slot(arg, pop())
+            else:
+                env_vars[slot_names[arg]] = pop()
+        elif op == NAME:
+            push(names[arg])
+        elif op == GT:
+            rr = pop()
+            push(TRUE if pop().get_number() > rr.get_number() else FALSE)
+        elif op == LT:
+            rr = pop()
+            push(TRUE if pop().get_number() < rr.get_number() else FALSE)
+        elif op == EQ:
+            rr = pop()
+            push(TRUE if pop() == rr else FALSE)
+        elif op == JUMP_IF_ZERO:
+            ec = pop()
+            if ec.__class__ is ValueNumber and ec.value == 0:
+                pc = arg
+        elif op == JUMP_IF_FALSE:
+            if not pop().get_number():
+                pc = arg
+        elif op == JUMP:
+            pc = arg
+        elif op == SUB or op == MUL or op == DIV or op == FLOORDIV:
+            rr = pop().get_number()
+            ll = pop().get_number()
+            binary = sub if op == SUB else mul if op == MUL else truediv if op == DIV else floordiv
+            push(number(binary(ll, rr)))
+        elif op == NEG:
+            push(number(-pop().get_number()))
+        elif op == NOT:
+            push(FALSE if pop().get_number() else TRUE)
+        elif op == CHECK_FUNC:
+            if not isinstance(stack[-1], ValueFunction):
+                raise Exception
+        elif op == CALL:
+            args = stack[len(stack) - arg:]
+            del stack[len(stack) - arg:]
+            func = pop()
+            push(execute(_program(func.value), scoped_environment(env, args)))
+        elif op == LOAD_NAME:
+            push(env_vars[pop()])
+        elif op == STORE_NAME:
+            name = pop()
+            env_vars[name] = pop()
+        elif op == TO_NAME:
+            name = pop().get_string()
+            if screept.debug_identifiers:
+                print("ID " + constants[arg], name)
+            push(name)
+        elif op == PROC_LOOKUP:
+            push(env.procedures[pop()])
+        elif op == PROC_CALL:
+            execute(_program(pop()), env, emit_handler)
+        elif op == PRINT:
+            env.output.append(pop().get_string())
+        elif op == EMIT:
+            emit_handler(pop().get_string())
+        elif op == PROC_DEF:
+            env.procedures[pop()] = constants[arg]
+        elif op == RND:
+            name = pop()
+            max_v = get_numerical_value(pop())
+            min_v = get_numerical_value(pop())
+            env_vars[name] = number(env.rng.randint(floor(min_v), floor(max_v)))
+        elif op == RAISE:
+            raise constants[arg]
+        else:
+            raise Exception("Unknown opcode " + str(op))
+    return stack[-1] if stack else None
+
+
+def evaluate_expression(e: Expression, env: Environment) -> Value:
+    """Drop-in replacement for screept.evaluate_expression"""
+    return execute(compile_cached(e), env)
+
+
+def run_statement(s: Statement, env: Environment, emit_handler: Callable[[str], None] = lambda x: None) -> None:
+    """Drop-in replacement for screept.run_statement"""
+    execute(compile_cached(s), env, emit_handler)
+
+
+def disassemble(program: Program) -> str:
+    lines = []
+    for pc in range(0, len(program.code), 2):
+        op = program.code[pc]
+        arg = program.code[pc + 1]
+        line = f"{pc:04d} {opcode_names[op]:<14}"
+        if op in (LOAD, STORE):
+            line += f"{arg} ({slots.names[arg]})"
+        elif op == NAME:
+            line += f"{arg} ({program.names[arg]})"
+        elif op in (CONST, TO_NAME, PROC_DEF, RAISE):
+            line += f"{arg} ({program.constants[arg]!r})"
+        elif op in (JUMP, JUMP_IF_ZERO, JUMP_IF_FALSE, CALL):
+            line += str(arg)
+        lines.append(line.rstrip())
+    return "\n".join(lines)
+
+
+#
+
+
+def random_expression(rng: random.Random, depth: int = 4) -> Expression:
+    """Random expression over the vars of `test_environment`, for differential testing"""
+    if depth == 0 or rng.random() < 0.2:
+        match rng.randrange(4):
+            case 0:
+                return ValueNumber(rng.choice([0, 1, 2, 3.5, -4]))
+            case 1:
+                return ValueString(rng.choice(["", "a", "xyz"]))
+            case 2:
+                return ExpressionVar(IdentifierLiteral(rng.choice(["a", "b", "s"])))
+            case _:
+                return ExpressionVar(IdentifierComputed(ValueString(rng.choice(["a", "b"]))))
+
+    def sub_expression() -> Expression:
+        return random_expression(rng, depth - 1)
+
+    match rng.randrange(7):
+        case 0:
+            return ExprBinaryOp(sub_expression(), rng.choice(["+", "-", "*", "//"]), sub_expression())
+        case 1:
+            return ExprUnaryOP(sub_expression(), rng.choice(["-", "!"]))
+        case 2:
+            return ExprConditional(sub_expression(), sub_expression(), sub_expression())
+        case 3:
+            return ExprComparisonEqual(sub_expression(), sub_expression())
+        case 4:
+            return ExprComparisonLess(sub_expression(), sub_expression())
+        case 5:
+            return ExprComparisonMore(sub_expression(), sub_expression())
+        case _:
+            return ExprFuncCall(IdentifierLiteral("f"), [sub_expression(), sub_expression()])
+
+
+def test_environment() -> Environment:
+    f = ExprBinaryOp(ExpressionVar(IdentifierLiteral('_0')), '+', ExpressionVar(IdentifierLiteral('_1')))
+    return Environment({'a': ValueNumber(2), 'b': ValueNumber(0), 's': ValueString("str"), 'f': ValueFunction(f)},
+                       {}, [])
+
+
+def _outcome(evaluate, e, env):
+    try:
+        return evaluate(e, env)
+    except Exception as ex:
+        return repr(ex)
+
+
+def test(count: int = 2000):
+    import contextlib
+    import io
+    import dialogs
+    rng = random.Random(0)
+    env = test_environment()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(count):
+            e = random_expression(rng)
+            assert _outcome(evaluate_expression, e, env) == _outcome(screept.evaluate_expression, e, env), e
+    for title in ["customGame", "fable"]:
+        game = dialogs.load_game(title)
+        env = game.game_state.environment
+        expressions = [screept.parse_expression('__statusLine()')]
+        for dialog in game.dialogs.values():
+            expressions += [dialog.text] + [o.text for o in dialog.options] + [o.condition for o in dialog.options
+                                                                                if o.condition is not None]
+        for e in expressions:
+            assert _outcome(evaluate_expression, e, env) == _outcome(screept.evaluate_expression, e, env), e
+        for stmt in env.procedures.values():
+            results = []
+            for run in [screept.run_statement, run_statement]:
+                # the copy has its own Rng at the same point, so both runs draw the same numbers
+                run_env = deepcopy(env)
+                run_env.vars['_0'] = ValueNumber(1)
+                try:
+                    run(stmt, run_env)
+                except Exception as ex:
+                    results.append(repr(ex))
+                else:
+                    results.append(run_env)
+            assert results[0] == results[1], stmt
+    # bodies defined by VM code are programs, and no AST is kept
+    # a copy, parse_statement keeps the ASTs it returns
+    stmt = deepcopy(screept.parse_statement("{ double = FUNC _0 * 2; PROC twice { x = double(_0) + double(_0) }; "
+                                            "RUN twice(a) }"))
+    env = test_environment()
+    run_statement(stmt, env)
+    assert env.vars['x'] == ValueNumber(8)
+    assert isinstance(env.vars['double'].value, Program) and isinstance(env.procedures['twice'], Program)
+    program = compile_cached(stmt)
+    pending = [program]
+    while pending:
+        constants = pending.pop().constants
+        assert not any(isinstance(c, (Expression, Statement)) and not isinstance(c, Value) for c in constants)
+        pending += [c for c in constants if isinstance(c, Program)]
+        pending += [c.value for c in constants if isinstance(c, ValueFunction)]
+    key = id(stmt)
+    assert key in _programs
+    del stmt
+    assert key not in _programs
+    print(disassemble(compile_expression(dialogs.load_game("customGame").game_state.environment.vars['__statusLine']
+                                         .value)))
+    print("OK")
+
+
+def benchmark():
+    import dialogs
+    for title in ["customGame", "fable"]:
+        env = dialogs.load_game(title).game_state.environment
+        nodes = list(env.procedures.values()) + [v.value for v in env.vars.values() if isinstance(v, ValueFunction)]
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        trees = deepcopy(nodes)
+        tree_size = tracemalloc.get_traced_memory()[0] - before
+        before = tracemalloc.get_traced_memory()[0]
+        programs = [compile_statement(n) if isinstance(n, Statement) else compile_expression(n) for n in nodes]
+        program_size = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        print(f"{title}: dataclass trees {tree_size} bytes, programs {program_size} bytes")
+        del trees, programs
+
+        expression = screept.parse_expression('__statusLine()')
+        timings = []
+        for evaluate in [screept.evaluate_expression, evaluate_expression]:
+            start = time.perf_counter()
+            for _ in range(2000):
+                _outcome(evaluate, expression, env)
+            timings.append(time.perf_counter() - start)
+        print(f"{title} status line: tree-walker {timings[0]:.3f}s VM {timings[1]:.3f}s")
+
+
+if __name__ == '__main__':
+    test()
+    benchmark()